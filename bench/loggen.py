@@ -0,0 +1,94 @@
+import random
+
+###################################
+## GENERATES SYNTHETIC JAVA LOGS ##
+###################################
+
+PACKAGES = ["com.ourco.payments", "com.ourco.orders", "com.ourco.http", "org.hibernate.engine", "java.util.concurrent"]
+CLASSES = ["Service", "Controller", "Repository", "Handler", "Worker", "Client", "Dispatcher"]
+METHODS = ["process", "handle", "execute", "call", "run", "apply", "lookup"]
+EXCEPTIONS = [
+    "java.lang.NullPointerException",
+    "java.lang.IllegalStateException",
+    "java.sql.SQLTimeoutException",
+    "java.io.IOException",
+    "java.util.concurrent.TimeoutException",
+    "com.ourco.payments.PaymentDeclinedException",
+]
+LEVELS = ["INFO", "INFO", "INFO", "DEBUG", "WARN"]
+
+# the message excluded errors carry, pair with EXCLUDE_PATTERNS
+EXCLUDED_MESSAGE = "HealthCheck failed"
+EXCLUDE_PATTERNS = {"healthcheck": "HealthCheck failed"}
+
+class LogGenerator(object):
+    """
+    Deterministically generates realistic Java log lines.
+
+    The same seed and settings always produce the same log, so results from different revisions
+    are measured against identical input. errorRate, excludedRate and causedByRate are the chance
+    of a log entry being an error, of an error being excluded, and of each trace having another
+    Caused by section. distinctTraces bounds how many different stack traces are thrown.
+    """
+
+    def __init__(self, seed=1, errorRate=0.05, excludedRate=0.1, causedByRate=0.4, minFrames=5, maxFrames=40, distinctTraces=50):
+        self.random = random.Random(seed)
+        self.errorRate = errorRate
+        self.excludedRate = excludedRate
+        self.causedByRate = causedByRate
+        # each distinct trace is a fixed exception and list of frames
+        self.traces = [self._makeTrace(self.random.randint(minFrames, maxFrames)) for i in range(distinctTraces)]
+        self.second = 0
+
+    def _makeFrame(self):
+        package = self.random.choice(PACKAGES)
+        className = self.random.choice(CLASSES)
+        return "at %s.%s.%s(%s.java:%d)" % (package, className, self.random.choice(METHODS), className, self.random.randint(10, 2000))
+
+    def _makeTrace(self, frames):
+        return (self.random.choice(EXCEPTIONS), [self._makeFrame() for i in range(frames)])
+
+    def _timestamp(self):
+        self.second += 1
+        return "2026-01-%02d %02d:%02d:%02d" % (1 + self.second // 86400 % 28, self.second // 3600 % 24, self.second // 60 % 60, self.second % 60)
+
+    def entries(self):
+        """ Generate log entries forever, each a list of lines without newlines. """
+        while True:
+            if self.random.random() >= self.errorRate:
+                yield ["%s %s [main] request %d handled" % (self._timestamp(), self.random.choice(LEVELS), self.random.randint(0, 10 ** 6))]
+            elif self.random.random() < self.excludedRate:
+                yield ["%s ERROR [monitor] %s" % (self._timestamp(), EXCLUDED_MESSAGE)]
+            else:
+                yield self._errorEntry()
+
+    def _errorEntry(self):
+        exception, frames = self.random.choice(self.traces)
+        lines = [
+            "%s ERROR [worker-%d] request %d failed" % (self._timestamp(), self.random.randint(1, 32), self.random.randint(0, 10 ** 6)),
+            "%s: id %d" % (exception, self.random.randint(0, 10 ** 6)),
+        ]
+        lines.extend(frames)
+        while self.random.random() < self.causedByRate:
+            causeException, causeFrames = self.random.choice(self.traces)
+            shownFrames = self.random.randint(1, len(causeFrames))
+            lines.append("Caused by: %s: 0x%x" % (causeException, self.random.getrandbits(32)))
+            lines.extend(causeFrames[:shownFrames])
+            lines.append("... %d more" % (len(causeFrames) - shownFrames + 1))
+        return lines
+
+    def lines(self, count):
+        """ Return at least count lines, ending on a complete entry. """
+        lines = []
+        for entry in self.entries():
+            lines.extend(entry)
+            if len(lines) >= count:
+                return lines
+
+    def errors(self, count):
+        """ Return count non-excluded errors as (shortError, fullError) pairs. """
+        errors = []
+        while len(errors) < count:
+            lines = [line + "\n" for line in self._errorEntry()]
+            errors.append((lines[0], "".join(lines)))
+        return errors
@@ -0,0 +1,242 @@
+import argparse
+import curses
+import io
+import json
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import tracer.parser
+from bench.loggen import LogGenerator, EXCLUDE_PATTERNS
+from tracer.common import DBManager
+from tracer.parser import LineClassifier, StdinParser, fingerprintError
+
+##################################
+## MEASURES TRACER'S THROUGHPUT ##
+##################################
+
+def timeCalls(call, repeat):
+    """ Run call repeat times and return timing stats in milliseconds. """
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        call()
+        times.append((time.perf_counter() - start) * 1000)
+    times.sort()
+    return {
+        "mean_ms": sum(times) / len(times),
+        "p50_ms": times[len(times) // 2],
+        "p95_ms": times[min(len(times) - 1, int(len(times) * 0.95))],
+        "calls": repeat,
+    }
+
+class NullSink(object):
+    """ Stands in for the database so only the parser is measured. """
+    def __init__(self):
+        self.errors = 0
+
+    def addError(self, shortError, fullError, fingerprint, source=None):
+        self.errors += 1
+
+    def flushIfDue(self):
+        pass
+
+    def flush(self):
+        pass
+
+class NullOutput(object):
+    def write(self, data):
+        return len(data)
+
+    def flush(self):
+        pass
+
+def benchParser(lines):
+    data = ("\n".join(LogGenerator(seed=1).lines(lines)) + "\n").encode("utf-8")
+    # excluded errors only count as excluded with the generator's patterns
+    tracer.parser.CLASSIFIER = LineClassifier(EXCLUDE_PATTERNS)
+    sink = NullSink()
+    start = time.perf_counter()
+    StdinParser(sink, io.BufferedReader(io.BytesIO(data)), NullOutput())
+    seconds = time.perf_counter() - start
+    return {
+        "lines": lines,
+        "bytes": len(data),
+        "errors": sink.errors,
+        "seconds": seconds,
+        "lines_per_sec": lines / seconds,
+        "mb_per_sec": len(data) / seconds / 1024 / 1024,
+    }
+
+def fillDB(db, generator, count):
+    errors = generator.errors(min(count, 5000))
+    fingerprints = [fingerprintError(fullError.splitlines(True)) for shortError, fullError in errors]
+    for i in range(count):
+        shortError, fullError = errors[i % len(errors)]
+        db.addError(shortError, fullError, fingerprints[i % len(errors)])
+    db.flush()
+
+def benchInserts(directory, count):
+    db = DBManager(os.path.join(directory, "inserts.db"))
+    generator = LogGenerator(seed=2)
+    errors = generator.errors(count)
+    fingerprints = [fingerprintError(fullError.splitlines(True)) for shortError, fullError in errors]
+    start = time.perf_counter()
+    for (shortError, fullError), fingerprint in zip(errors, fingerprints):
+        db.addError(shortError, fullError, fingerprint)
+    db.flush()
+    seconds = time.perf_counter() - start
+    db.close()
+    return {"inserts": count, "seconds": seconds, "inserts_per_sec": count / seconds, "batch_size": db.batchSize}
+
+def benchReads(directory, sizes, repeat, fullListLimit):
+    dbFile = os.path.join(directory, "reads.db")
+    db = DBManager(dbFile)
+    # big batches, this only sets up the data
+    db.batchSize = 10000
+    generator = LogGenerator(seed=3, distinctTraces=500)
+    results = {}
+    rows = 0
+    pickRandom = random.Random(4)
+    for size in sorted(sizes):
+        fillDB(db, generator, size - rows)
+        rows = size
+        reader = DBManager(dbFile, readOnly=True)
+        result = {
+            "file_bytes": os.path.getsize(dbFile),
+            "fetchErrorsBefore_newest_page": timeCalls(lambda: reader.fetchErrorsBefore(None, 100), repeat),
+            "fetchErrorsAfter_oldest_page": timeCalls(lambda: reader.fetchErrorsAfter(None, 100), repeat),
+            "fetchErrorDetail": timeCalls(lambda: reader.fetchErrorDetail(pickRandom.randint(1, size)), repeat),
+        }
+        if size <= fullListLimit:
+            result["fetchErrors"] = timeCalls(reader.fetchErrors, max(1, repeat // 10))
+        reader.close()
+        results[str(size)] = result
+    db.close()
+    return results
+
+class FakeWindow(object):
+    """ Enough of a curses window to draw the viewer into without a terminal. """
+    def __init__(self, lines, cols):
+        self.lines = lines
+        self.cols = cols
+        self.bytesWritten = 0
+
+    def getmaxyx(self):
+        return (self.lines, self.cols)
+
+    def subwin(self, lines, cols, y, x):
+        return FakeWindow(lines, cols)
+
+    def addstr(self, y, x, s, attr=0):
+        self.bytesWritten += len(s)
+
+    def resize(self, lines, cols):
+        self.lines = lines
+        self.cols = cols
+
+    def keypad(self, flag): pass
+    def idlok(self, flag): pass
+    def scrollok(self, flag): pass
+    def scroll(self, lines): pass
+    def move(self, y, x): pass
+    def clrtoeol(self): pass
+    def clear(self): pass
+    def erase(self): pass
+    def refresh(self, *args): pass
+    def noutrefresh(self, *args): pass
+
+class FakeSource(object):
+    def __init__(self, count):
+        self.count = count
+
+    def fetchBefore(self, itemData, limit):
+        end = self.count + 1 if itemData is None else itemData
+        return [("error %d" % i, i) for i in range(max(1, end - limit), end)]
+
+    def fetchAfter(self, itemData, limit):
+        start = 1 if itemData is None else itemData + 1
+        return [("error %d" % i, i) for i in range(start, min(self.count + 1, start + limit))]
+
+def benchView(repeat, traceLines):
+    # the viewer only needs this from curses to draw
+    curses.color_pair = lambda pair: 0
+    from tracer.view import DataList, DetailPane
+    window = FakeWindow(60, 200)
+    dataList = DataList(window, FakeSource(10 ** 6))
+    dataList.scrollBottom()
+    detailPane = DetailPane(window)
+    trace = "\n".join(LogGenerator(seed=5, minFrames=traceLines, maxFrames=traceLines, distinctTraces=1).errors(1)[0][1].splitlines()[:traceLines])
+    return {
+        "DataList.redraw": timeCalls(dataList.redraw, repeat),
+        "DataList.scrollUp": timeCalls(dataList.scrollUp, repeat),
+        "DetailPane.setData": timeCalls(lambda: detailPane.setData(trace), max(1, repeat // 10)),
+        "DetailPane.scrollPageDown": timeCalls(detailPane.scrollPageDown, repeat),
+        "trace_lines": traceLines,
+    }
+
+def gitRevision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL, cwd=os.path.dirname(__file__)).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(args):
+    results = {
+        "revision": gitRevision(),
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "parser": benchParser(args.lines),
+    }
+    with tempfile.TemporaryDirectory() as directory:
+        results["inserts"] = benchInserts(directory, args.inserts)
+        results["reads"] = benchReads(directory, args.sizes, args.repeat, args.full_list_limit)
+    results["view"] = benchView(args.repeat, args.trace_lines)
+    return results
+
+def compare(oldFile, newFile):
+    """ Print every number that differs between two result files, with the new/old ratio. """
+    with open(oldFile) as f:
+        old = json.load(f)
+    with open(newFile) as f:
+        new = json.load(f)
+    def walk(oldValue, newValue, path):
+        if isinstance(newValue, dict):
+            for key in newValue:
+                if isinstance(oldValue, dict) and key in oldValue:
+                    walk(oldValue[key], newValue[key], path + [key])
+        elif isinstance(newValue, (int, float)) and isinstance(oldValue, (int, float)) and oldValue and oldValue != newValue:
+            print("%-70s %14.4f %14.4f %7.2fx" % (".".join(path), oldValue, newValue, newValue / oldValue))
+    print("%-70s %14s %14s %8s" % ("", str(old.get("revision"))[:12], str(new.get("revision"))[:12], "new/old"))
+    walk(old, new, [])
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description="Benchmarks tracer's parser, database and viewer and writes the results as JSON.")
+    parser.add_argument("--output", help="file to write the JSON results to (default stdout)")
+    parser.add_argument("--lines", type=int, default=200000, help="log lines to parse")
+    parser.add_argument("--inserts", type=int, default=20000, help="errors to insert")
+    parser.add_argument("--sizes", type=lambda s: [int(float(size)) for size in s.split(",")], default=[10 ** 3, 10 ** 4, 10 ** 5],
+                        help="comma separated database sizes to time reads at, e.g. 1e3,1e5,1e7")
+    parser.add_argument("--full-list-limit", type=int, default=10 ** 5, help="largest size to time the full fetchErrors at")
+    parser.add_argument("--repeat", type=int, default=200, help="calls per timed operation")
+    parser.add_argument("--trace-lines", type=int, default=50000, help="length of the trace shown in the detail pane")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two result files instead of running")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parseArgs()
+    if args.compare:
+        compare(*args.compare)
+        sys.exit()
+    output = json.dumps(run(args), indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
@@ -1,24 +1,125 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import argparse
 import atexit
 import sys
-from tracer.common import DBManager
+from tracer.shards import openDB
 
 def closeDB(db):
     db.close()
 
+def parseArgs():
+    parser = argparse.ArgumentParser(
+        description="Parses stdin for Java exceptions and saves them to a database. "
+                    "When run with stdin attached to a tty, displays the saved errors instead.")
+    parser.add_argument("dbFile")
+    parser.add_argument("--serve", metavar="ADDRESS", action="append",
+                        help="collect log streams from clients on unix:PATH or [tcp:][HOST:]PORT (may be repeated)")
+    parser.add_argument("--import", dest="importFiles", metavar="FILE", nargs="+",
+                        help="parse log files (globs and .gz, .bz2 or .xz archives too) into the database and exit")
+    parser.add_argument("--follow", metavar="FILE", nargs="+",
+                        help="follow log files like tail -F, through log rotation, saving their errors")
+    parser.add_argument("--report", choices=("top", "traces", "rate", "new"),
+                        help="print a report and exit: the most common traces per time bucket, every trace "
+                             "with its first and last sighting, errors per time bucket, or traces first seen recently")
+    parser.add_argument("--export", metavar="FILE",
+                        help="write the stored errors with their full traces to FILE (- for stdout, gzip compressed "
+                             "if it ends in .gz) and exit")
+    parser.add_argument("--format", choices=("json", "csv"), default="json",
+                        help="report and export output format (default json, one object per line for exports)")
+    parser.add_argument("--bucket", choices=("hour", "day", "week", "month"), default="day", help="report time bucket (default day)")
+    parser.add_argument("--top", type=int, default=10, metavar="N", help="traces per bucket in the top report (default 10)")
+    parser.add_argument("--since", metavar="TIME",
+                        help="start of the report or export, UTC like 2026-01-31 or relative like 12h or 7d (default the last day "
+                             "for the new report, otherwise all time)")
+    parser.add_argument("--until", metavar="TIME", help="end of the report or export, in the same form as --since")
+    parser.add_argument("--from-id", type=int, metavar="ID", help="only export errors after this id")
+    parser.add_argument("--to-id", type=int, metavar="ID", help="only export errors up to and including this id")
+    parser.add_argument("--include", metavar="PATTERN", action="append",
+                        help="only export errors whose trace matches this regular expression (may be repeated)")
+    parser.add_argument("--exclude", metavar="PATTERN", action="append",
+                        help="leave out errors whose trace matches this regular expression (may be repeated)")
+    parser.add_argument("--mark", metavar="FILE",
+                        help="export only the errors added since the last export with the same mark FILE, and update it")
+    parser.add_argument("--train-dictionary", action="store_true",
+                        help="build a compression dictionary from the stored traces and exit")
+    parser.add_argument("--recompress", action="store_true",
+                        help="store every trace again with the current compression settings and exit")
+    parser.add_argument("--prune", action="store_true",
+                        help="delete the errors past the [retention] limits and exit")
+    parser.add_argument("--vacuum", action="store_true",
+                        help="compact the database and switch it to incremental vacuuming, then exit")
+    return parser.parse_args()
+
+def startWriter(db):
+    from tracer.limiter import ErrorLimiter
+    from tracer.metrics import startMetrics
+    from tracer.writer import ErrorWriter
+    writer = ErrorWriter(db)
+    # registered after closeDB so it runs first, draining the queue before the database closes
+    atexit.register(writer.close)
+    startMetrics(db, writer)
+    return ErrorLimiter(writer)
+
 
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print("Usage: " + sys.argv[0] + " dbFile")
-        exit()
-    db = DBManager(sys.argv[1])
+    args = parseArgs()
+    if args.train_dictionary or args.recompress or args.prune or args.vacuum:
+        db = openDB(args.dbFile)
+        atexit.register(closeDB, db)
+        if args.train_dictionary:
+            size = db.trainDictionary()
+            print("Trained a " + str(size) + " byte dictionary" if size else "Not enough repeated trace lines to train a dictionary")
+        if args.recompress:
+            print("Recompressed " + str(db.recompressTraces()) + " traces")
+        if args.prune:
+            while db.pruneStep(): pass
+        if args.vacuum:
+            db.enableIncrementalVacuum()
+        sys.exit()
+    if args.report:
+        from tracer.report import parseReportTime, runReport
+        db = openDB(args.dbFile, readOnly=True)
+        atexit.register(closeDB, db)
+        runReport(db, args.report, args.format, args.bucket, args.top,
+                  parseReportTime(args.since) if args.since else None,
+                  parseReportTime(args.until) if args.until else None)
+        sys.exit()
+    if args.export:
+        from tracer.export import runExport
+        from tracer.report import parseReportTime
+        db = openDB(args.dbFile, readOnly=True)
+        atexit.register(closeDB, db)
+        count = runExport(db, args.export, args.format, args.from_id, args.to_id,
+                          parseReportTime(args.since) if args.since else None,
+                          parseReportTime(args.until) if args.until else None,
+                          args.include, args.exclude, args.mark)
+        if args.export != "-":
+            print("Exported " + str(count) + " errors")
+        sys.exit()
+    if args.importFiles:
+        from tracer.importer import LogImporter
+        db = openDB(args.dbFile)
+        atexit.register(closeDB, db)
+        print("Imported " + str(LogImporter(db).importFiles(args.importFiles)) + " errors")
+        sys.exit()
+    viewing = sys.stdin.isatty() and not args.serve and not args.follow
+    # the viewer only reads, so it never holds a write lock that would block parsers
+    db = openDB(args.dbFile, readOnly=viewing)
     atexit.register(closeDB, db)
-    if sys.stdin.isatty():
+    if args.follow:
+        from tracer.follower import FileFollower
+        from tracer.metrics import startMetrics
+        startMetrics(db, db)
+        FileFollower(db, args.follow).run()
+    elif args.serve:
+        from tracer.server import TraceServer
+        TraceServer(startWriter(db), args.serve).run()
+    elif viewing:
         from curses import wrapper
         from tracer.view import MainWin
         wrapper(MainWin, db)
     else:
         from tracer.parser import StdinParser
-        StdinParser(db)
+        StdinParser(startWriter(db))
\ No newline at end of file
@@ -1,50 +1,805 @@
+import heapq
+import itertools
 import os
+import re
 import sqlite3
+import time
+from urllib.request import pathname2url
+from tracer.compression import TraceCodec, trainDictionary
+from tracer.config import config
 
 ############################################
 ## MANAGES THE CONNECTION TO THE DATABASE ##
 ############################################
 
+def currentTimestamp():
+    """ The current UTC time in the same format as sqlite's current_timestamp. """
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+
+JOURNAL_MODES = ("DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF")
+SYNCHRONOUS_LEVELS = ("OFF", "NORMAL", "FULL", "EXTRA")
+
+def getPragmaValue(section, key, allowed):
+    value = config[section][key].strip().upper()
+    if value not in allowed:
+        raise Exception("Invalid value for " + key + ": " + value)
+    return value
+
+SCHEMA_VERSION = 10
+# compression dictionaries, see tracer.compression
+DICTIONARIES_SCHEMA = '''
+create table dictionaries (
+    id integer primary key autoincrement,
+    created datetime default current_timestamp,
+    data blob not null
+)'''
+# how far each imported log file has been read, see tracer.importer
+CHECKPOINTS_SCHEMA = '''
+create table checkpoints (
+    path text primary key,
+    inode integer,
+    byte_offset integer not null default 0,
+    file_size integer,
+    complete integer not null default 0,
+    updated datetime default current_timestamp
+)'''
+# the exception classes and frame methods of each trace, interned, see _indexTrace
+FRAME_INDEX_SCHEMA = (
+    '''
+create table exception_classes (
+    id integer primary key,
+    name text not null unique,
+    simple_name text not null
+)''',
+    "create index exception_classes_simple_name on exception_classes (simple_name)",
+    '''
+create table trace_exceptions (
+    trace_id integer not null references traces (id),
+    depth integer not null,
+    class_id integer not null references exception_classes (id),
+    is_root integer not null default 0,
+    primary key (trace_id, depth)
+) without rowid''',
+    "create index trace_exceptions_class on trace_exceptions (class_id, is_root, trace_id)",
+    '''
+create table frames (
+    id integer primary key,
+    name text not null unique
+)''',
+    '''
+create table trace_frames (
+    frame_id integer not null references frames (id),
+    trace_id integer not null references traces (id),
+    primary key (frame_id, trace_id)
+) without rowid''',
+)
+SCHEMA = (
+    '''
+create table traces (
+    id integer primary key autoincrement,
+    fingerprint text not null unique,
+    short_error text,
+    full_error text,
+    count integer not null default 0,
+    first_seen datetime,
+    last_seen datetime,
+    encoding integer not null default 0,
+    dictionary_id integer references dictionaries (id)
+)''',
+    '''
+create table errors (
+    id integer primary key autoincrement,
+    date datetime default current_timestamp,
+    trace_id integer not null references traces (id),
+    source text,
+    occurrences integer not null default 1
+)''',
+    # sqlite ends every index entry with the rowid, so each trace's errors are in id order
+    "create index errors_trace_id on errors (trace_id)",
+    # trace_id and occurrences too, so the reports can count errors by time and trace from the index alone
+    "create index errors_date on errors (date, trace_id, occurrences)",
+    "create index traces_first_seen on traces (first_seen)",
+    DICTIONARIES_SCHEMA,
+    CHECKPOINTS_SCHEMA,
+) + FRAME_INDEX_SCHEMA
+# statements moving a database from the version before to the key's version
+SCHEMA_UPGRADES = {
+    2: ("alter table errors add column source text",),
+    # version 3 adds the search index, see _createSearchIndex
+    3: (),
+    4: (
+        "alter table traces add column encoding integer not null default 0",
+        "alter table traces add column dictionary_id integer references dictionaries (id)",
+        DICTIONARIES_SCHEMA,
+    ),
+    5: (CHECKPOINTS_SCHEMA,),
+    6: (
+        "drop index errors_date",
+        "create index errors_date on errors (date, trace_id)",
+        "create index traces_first_seen on traces (first_seen)",
+    ),
+    # a row can stand for many occurrences held back by the rate limit, see tracer.limiter
+    7: (
+        "alter table errors add column occurrences integer not null default 1",
+        "drop index errors_date",
+        "create index errors_date on errors (date, trace_id, occurrences)",
+    ),
+    # version 8 also indexes the traces already stored, see _indexAllTraces
+    8: FRAME_INDEX_SCHEMA,
+    # version 9 fingerprints the traces already stored again, see _refingerprintTraces
+    9: (),
+    10: (
+        "drop index errors_trace_id",
+        "create index errors_trace_id on errors (trace_id)",
+    ),
+}
+# contentless, the text lives in traces and only the index is kept here
+SEARCH_INDEX_SCHEMA = "create virtual table traces_fts using fts5 (short_error, full_error, content='')"
+# a search picks the matching traces, these filter them
+MATCHING_TRACES_QUERY = "select id from traces where "
+SEARCH_FILTER = "id in (select rowid from traces_fts where traces_fts match ?)"
+# search words that filter by the frame index instead: class:NAME, root:NAME and at:PACKAGE
+TRACE_FILTER = re.compile(r"^(class|root|at):(\S+)$")
+EXCEPTION_FILTER = '''id in (select trace_id from trace_exceptions where class_id in (
+    select id from exception_classes where name = ? or simple_name = ?))'''
+ROOT_CAUSE_FILTER = '''id in (select trace_id from trace_exceptions where is_root = 1 and class_id in (
+    select id from exception_classes where name = ? or simple_name = ?))'''
+# a package, class or method name, and everything under it ('/' is the character after '.')
+FRAME_FILTER = '''id in (select trace_id from trace_frames where frame_id in (
+    select id from frames where name = ? or (name > ? and name < ?)))'''
+
+ERROR_LIST_QUERY = '''
+select errors.id, datetime(errors.date, 'localtime'), traces.short_error, errors.source, errors.occurrences
+from errors join traces on traces.id = errors.trace_id
+'''
+LAST_ERROR_ID = 2 ** 63 - 1
+INCREMENTAL_VACUUM = 2
+# strftime formats for the report time buckets
+REPORT_BUCKETS = {
+    "hour": "%Y-%m-%d %H:00",
+    "day": "%Y-%m-%d",
+    "week": "%Y-W%W",
+    "month": "%Y-%m",
+}
+
+def toSearchQuery(text):
+    """ Turn what the user typed into an fts5 query matching every word as a prefix. """
+    words = text.split()
+    return " AND ".join('"' + word.replace('"', '""') + '"*' for word in words)
+
+def needsSearchIndex(text):
+    """ Whether a search has plain words, which only the fts5 search index can match. """
+    return any(TRACE_FILTER.match(word) is None for word in text.split())
+
+def isBusyError(e):
+    message = str(e)
+    return "locked" in message or "busy" in message
+
 class DBManager(object):
-    def __init__(self, file):
-        newDB = not os.path.isfile(file)
-        self.conn = sqlite3.connect(file)
+    def __init__(self, file, readOnly=False):
+        self.file = file
+        self.readOnly = readOnly
+        busyTimeout = config.getint("database", "busyTimeout") / 1000
+        self.busyRetries = config.getint("database", "busyRetries")
+        if readOnly:
+            # a read only connection can't create or upgrade the schema, so let a writable one do it first
+            if not os.path.isfile(file) or DBManager._fetchSchemaVersion(file) != SCHEMA_VERSION:
+                DBManager(file).close()
+            uri = "file:" + pathname2url(os.path.abspath(file)) + "?mode=ro"
+            self.conn = sqlite3.connect(uri, uri=True, timeout=busyTimeout, check_same_thread=False)
+        else:
+            # the connection may be handed to a background ErrorWriter thread
+            self.conn = sqlite3.connect(file, timeout=busyTimeout, check_same_thread=False)
         self.cursor = self.conn.cursor()
-        if newDB:
-            self._initDB()
+        # errors are queued and written in a single transaction
+        self.batchSize = config.getint("database", "batchSize")
+        self.batchInterval = config.getint("database", "batchInterval") / 1000
+        self.pendingErrors = []
+        self.pendingSince = None
+        # path -> (inode, offset, file size, complete), committed with the errors read before the offset
+        self.pendingCheckpoints = {}
+        # fingerprint -> trace id, saves a lookup for errors seen before. Only trusted while no
+        # other connection has written, another process may have pruned the traces since
+        self.traceIds = {}
+        self.traceIdsVersion = None
+        # name -> id for the interned exception classes and frames
+        self.classIds = {}
+        self.frameIds = {}
+        self.canSearch = False
+        self.codec = TraceCodec(
+            config["database"]["compression"].strip().lower() == "zlib",
+            config.getint("database", "compressionLevel"))
+        # retention limits, 0 turns a limit off
+        self.maxAge = config.getint("retention", "maxAge")
+        self.maxRows = config.getint("retention", "maxRows")
+        self.maxSize = config.getint("retention", "maxSize") * 1024 * 1024
+        self.pruneBatchSize = config.getint("retention", "batchSize")
+        self.vacuumPages = config.getint("retention", "vacuumPages")
+        self.hasRetention = bool(self.maxAge or self.maxRows or self.maxSize)
+        # the newest error past maxRows, kept until everything up to it is deleted
+        self.lastExpiredId = None
+        if not readOnly:
+            # only takes effect before the first table is created, see --vacuum for older databases
+            self._query("pragma auto_vacuum = incremental")
+            self._withRetry(self._query, "pragma journal_mode = " + getPragmaValue("database", "journalMode", JOURNAL_MODES))
+            self._query("pragma synchronous = " + getPragmaValue("database", "synchronous", SYNCHRONOUS_LEVELS))
+            self._withRetry(self._checkSchema)
+        # the search index is missing if sqlite was built without fts5
+        self.canSearch = self._query("select count(*) from sqlite_master where name = 'traces_fts'")[0][0] > 0
+        if self.codec.enabled and config.getboolean("database", "useDictionary"):
+            self._useLatestDictionary()
+
+    @staticmethod
+    def _fetchSchemaVersion(file):
+        conn = sqlite3.connect(file)
+        try:
+            return conn.execute("pragma user_version").fetchone()[0]
+        finally:
+            conn.close()
 
     def _query(self, query, *params):
         self.cursor.execute(query, params)
         self.conn.commit()
         return self.cursor.fetchall()
 
+    def _iterQuery(self, query, *params):
+        """ Yield the rows of a query as sqlite produces them, so big results never have to fit in memory. """
+        cursor = self.conn.cursor()
+        cursor.execute(query, params)
+        for row in cursor:
+            yield row
+
     def close(self):
+        self.flush()
         self.conn.close()
 
-    def _initDB(self):
-        self._query('''
-create table errors (
-    id integer primary key autoincrement,
-    date datetime default current_timestamp,
-    short_error text,
-    full_error text
-);
-            ''')
+    def _withRetry(self, write, *args):
+        """ Run a write, backing off and trying again while other connections keep the database locked. """
+        delay = 0.05
+        for attempt in range(self.busyRetries + 1):
+            try:
+                return write(*args)
+            except sqlite3.OperationalError as e:
+                if not isBusyError(e) or attempt == self.busyRetries:
+                    raise
+                time.sleep(delay)
+                delay = min(delay * 2, 2)
+
+    def _checkSchema(self):
+        version = self._query("pragma user_version")[0][0]
+        if version == SCHEMA_VERSION:
+            return
+        # take the write lock before looking again, another process may be creating the database too
+        self.cursor.execute("begin immediate")
+        try:
+            version = self.cursor.execute("pragma user_version").fetchone()[0]
+            if version == 0:
+                self.cursor.execute("select count(*) from sqlite_master where type = 'table' and name = 'errors'")
+                if self.cursor.fetchone()[0]:
+                    self._migrateDB()
+                else:
+                    self._createSchema()
+            elif version < SCHEMA_VERSION:
+                self._upgradeSchema(version)
+            self.conn.commit()
+        except:
+            self.conn.rollback()
+            self._clearIdCaches()
+            raise
+
+    def _clearIdCaches(self):
+        # after a rollback the cached ids may point at rows that were never committed
+        self.traceIds.clear()
+        self.classIds.clear()
+        self.frameIds.clear()
+
+    def _createSchema(self):
+        for statement in SCHEMA:
+            self.cursor.execute(statement)
+        self._createSearchIndex(False)
+        self.cursor.execute("pragma user_version = %d" % SCHEMA_VERSION)
+
+    def _upgradeSchema(self, version):
+        # upgrades that delete traces take them out of the search index too
+        self.canSearch = self.cursor.execute("select count(*) from sqlite_master where name = 'traces_fts'").fetchone()[0] > 0
+        for upgradeVersion in range(version + 1, SCHEMA_VERSION + 1):
+            for statement in SCHEMA_UPGRADES[upgradeVersion]:
+                self.cursor.execute(statement)
+        if version < 3:
+            self._createSearchIndex(True)
+        if version < 8:
+            self._indexAllTraces()
+        if version < 9:
+            self._refingerprintTraces()
+        self.cursor.execute("pragma user_version = %d" % SCHEMA_VERSION)
+
+    def _createSearchIndex(self, backfill):
+        try:
+            self.cursor.execute(SEARCH_INDEX_SCHEMA)
+        except sqlite3.OperationalError:
+            # no fts5 in this sqlite, searching just won't be available
+            return
+        self.canSearch = True
+        if backfill:
+            self.cursor.execute("insert into traces_fts (rowid, short_error, full_error) select id, short_error, full_error from traces")
+
+    def _migrateDB(self):
+        """ Move a database from before fingerprinting to one trace row per distinct error. """
+        from tracer.parser import fingerprintError
+        self.cursor.execute("alter table errors rename to errors_v0")
+        self._createSchema()
+        legacyCursor = self.conn.cursor()
+        legacyCursor.execute("select id, date, short_error, full_error from errors_v0 order by id")
+        for errorId, date, shortError, fullError in legacyCursor:
+            traceId = self._getTraceId(shortError, fullError, fingerprintError(fullError.splitlines()), date)
+            self.cursor.execute("insert into errors (id, date, trace_id) values (?, ?, ?)", (errorId, date, traceId))
+            self.cursor.execute("update traces set count = count + 1, last_seen = ? where id = ?", (date, traceId))
+        self.cursor.execute("drop table errors_v0")
+
+    def _getTraceId(self, shortError, fullError, fingerprint, date):
+        """ Find the trace with the given fingerprint, storing it first if it has not been seen yet. """
+        traceId = self.traceIds.get(fingerprint)
+        if traceId is not None:
+            return traceId
+        self.cursor.execute("select id from traces where fingerprint = ?", (fingerprint,))
+        row = self.cursor.fetchone()
+        if row:
+            traceId = row[0]
+        else:
+            storedError, encoding, dictionaryId = self.codec.encode(fullError)
+            self.cursor.execute(
+                "insert into traces (fingerprint, short_error, full_error, encoding, dictionary_id, first_seen, last_seen) values (?, ?, ?, ?, ?, ?, ?)",
+                (fingerprint, shortError, storedError, encoding, dictionaryId, date, date))
+            traceId = self.cursor.lastrowid
+            if self.canSearch:
+                self.cursor.execute(
+                    "insert into traces_fts (rowid, short_error, full_error) values (?, ?, ?)",
+                    (traceId, shortError, fullError))
+            self._indexTrace(traceId, fullError)
+        if len(self.traceIds) >= 10000:
+            self.traceIds.clear()
+        self.traceIds[fingerprint] = traceId
+        return traceId
+
+    def _indexTrace(self, traceId, fullError):
+        """ Record the exception classes and frame methods of a new trace, for the class:, root: and at: filters. """
+        from tracer.parser import parseTrace
+        classes, methods = parseTrace(fullError)
+        self.cursor.executemany(
+            "insert into trace_exceptions (trace_id, depth, class_id, is_root) values (?, ?, ?, ?)",
+            [(traceId, depth, self._internId("exception_classes", self.classIds, className), int(depth == len(classes) - 1))
+             for depth, className in enumerate(classes)])
+        # each method once, however many times the trace passes through it
+        self.cursor.executemany(
+            "insert into trace_frames (frame_id, trace_id) values (?, ?)",
+            [(self._internId("frames", self.frameIds, method), traceId) for method in dict.fromkeys(methods)])
+
+    def _internId(self, table, ids, name):
+        """ Find the id of a name in exception_classes or frames, adding it if it is new. """
+        internedId = ids.get(name)
+        if internedId is not None:
+            return internedId
+        self.cursor.execute("select id from " + table + " where name = ?", (name,))
+        row = self.cursor.fetchone()
+        if row:
+            internedId = row[0]
+        elif table == "exception_classes":
+            self.cursor.execute("insert into exception_classes (name, simple_name) values (?, ?)", (name, name.rsplit(".", 1)[-1]))
+            internedId = self.cursor.lastrowid
+        else:
+            self.cursor.execute("insert into frames (name) values (?)", (name,))
+            internedId = self.cursor.lastrowid
+        if len(ids) >= 10000:
+            ids.clear()
+        ids[name] = internedId
+        return internedId
+
+    def _unindexFrames(self, traceId, fullError):
+        """
+        Take a deleted trace out of trace_frames. Its frames are found from its text again, which
+        saves keeping a second index on trace_frames that every new trace would have to update.
+        """
+        from tracer.parser import parseTrace
+        methods = list(dict.fromkeys(parseTrace(fullError)[1]))
+        if methods:
+            self.cursor.execute(
+                "delete from trace_frames where trace_id = ? and frame_id in (select id from frames where name in (" +
+                ",".join("?" * len(methods)) + "))", [traceId] + methods)
+
+    def _indexAllTraces(self):
+        traceCursor = self.conn.cursor()
+        traceCursor.execute("select id, full_error, encoding, dictionary_id from traces")
+        for traceId, storedError, encoding, dictionaryId in traceCursor:
+            self._indexTrace(traceId, self._decodeTrace(storedError, encoding, dictionaryId))
+
+    def _refingerprintTraces(self):
+        """
+        Fingerprint the stored traces again after the frame normalization changed. Traces that
+        now have the same fingerprint are merged into the oldest of them.
+        """
+        from tracer.parser import fingerprintError
+        # clear the old fingerprints first, a trace's new fingerprint may be another trace's old one
+        self.cursor.execute("update traces set fingerprint = '#' || id")
+        traceIds = [row[0] for row in self.cursor.execute("select id from traces order by id").fetchall()]
+        for traceId in traceIds:
+            self.cursor.execute(
+                "select short_error, full_error, encoding, dictionary_id, count, first_seen, last_seen from traces where id = ?", (traceId,))
+            shortError, storedError, encoding, dictionaryId, count, firstSeen, lastSeen = self.cursor.fetchone()
+            fullError = self._decodeTrace(storedError, encoding, dictionaryId)
+            fingerprint = fingerprintError(fullError.splitlines())
+            self.cursor.execute("select id from traces where fingerprint = ?", (fingerprint,))
+            row = self.cursor.fetchone()
+            if row is None:
+                self.cursor.execute("update traces set fingerprint = ? where id = ?", (fingerprint, traceId))
+                continue
+            self.cursor.execute("update errors set trace_id = ? where trace_id = ?", (row[0], traceId))
+            self.cursor.execute(
+                "update traces set count = count + ?, first_seen = min(first_seen, ?), last_seen = max(last_seen, ?) where id = ?",
+                (count, firstSeen, lastSeen, row[0]))
+            self._deleteTrace(traceId, shortError, fullError)
+        self.traceIds.clear()
 
-    def addError(self, shortError, fullError):
-        self._query("insert into errors (short_error, full_error) values (?, ?)", shortError, fullError)
+    def addError(self, shortError, fullError, fingerprint, date=None, source=None, occurrences=1):
+        # record the time now so queued errors keep the time they happened
+        if date is None:
+            date = currentTimestamp()
+        if not self.pendingErrors:
+            self.pendingSince = time.monotonic()
+        self.pendingErrors.append((date, shortError, fullError, fingerprint, source, occurrences))
+        if len(self.pendingErrors) >= self.batchSize:
+            self.flush()
+        else:
+            self.flushIfDue()
+
+    def flushIfDue(self):
+        """ Commit the queued errors if the oldest has waited longer than the batch interval. """
+        if self.pendingErrors and time.monotonic() - self.pendingSince >= self.batchInterval:
+            self.flush()
+
+    def flush(self):
+        """ Write all queued errors in a single transaction. """
+        if not self.pendingErrors and not self.pendingCheckpoints:
+            return
+        self._withRetry(self._writePendingErrors)
+        self.pendingErrors[:] = []
+        self.pendingSince = None
+        self.pendingCheckpoints.clear()
+
+    def _writePendingErrors(self):
+        occurrences = []
+        counts = {}
+        try:
+            # take the write lock up front so the trace lookups can't go stale before the inserts
+            self.cursor.execute("begin immediate")
+            dataVersion = self.cursor.execute("pragma data_version").fetchone()[0]
+            if dataVersion != self.traceIdsVersion:
+                self.traceIds.clear()
+                self.traceIdsVersion = dataVersion
+            for date, shortError, fullError, fingerprint, source, occurrenceCount in self.pendingErrors:
+                traceId = self._getTraceId(shortError, fullError, fingerprint, date)
+                occurrences.append((date, traceId, source, occurrenceCount))
+                count, lastSeen = counts.get(traceId, (0, date))
+                counts[traceId] = (count + occurrenceCount, max(lastSeen, date))
+            self.cursor.executemany("insert into errors (date, trace_id, source, occurrences) values (?, ?, ?, ?)", occurrences)
+            self.cursor.executemany(
+                "update traces set count = count + ?, last_seen = max(last_seen, ?) where id = ?",
+                [(count, lastSeen, traceId) for traceId, (count, lastSeen) in counts.items()])
+            for path, (inode, offset, fileSize, complete) in self.pendingCheckpoints.items():
+                # a renamed file (a rotated archive) keeps its inode, its old checkpoint is replaced
+                self.cursor.execute("delete from checkpoints where inode = ? and path != ?", (inode, path))
+                self.cursor.execute(
+                    "insert or replace into checkpoints (path, inode, byte_offset, file_size, complete, updated) values (?, ?, ?, ?, ?, current_timestamp)",
+                    (path, inode, offset, fileSize, int(complete)))
+            self.conn.commit()
+        except sqlite3.Error:
+            # the cached ids may point at traces that were just rolled back
+            self.conn.rollback()
+            self._clearIdCaches()
+            raise
+
+    def setCheckpoint(self, path, inode, offset, fileSize, complete=False):
+        """ Record how far a file has been read, written in the same transaction as the errors queued so far. """
+        self.pendingCheckpoints[path] = (inode, offset, fileSize, complete)
+
+    def fetchCheckpoint(self, path, inode):
+        """
+        Fetch (inode, offset, file size, complete) for the file at path, or for the file with the
+        given inode if it has been renamed since. Returns None if neither has been read before.
+        """
+        results = self._query('''
+select inode, byte_offset, file_size, complete from checkpoints
+where path = ? or inode = ? order by path = ? desc limit 1;''', path, inode, path)
+        if not results:
+            return None
+        inode, offset, fileSize, complete = results[0]
+        return (inode, offset, fileSize, bool(complete))
 
     def fetchErrors(self):
-        queryResults = self._query("select id,datetime(date,'localtime'),short_error from errors order by date desc;")
+        queryResults = self._query(ERROR_LIST_QUERY + "order by errors.date desc;")
         errorList = []
         for queryResult in reversed(queryResults):
             errorList.append(Error(*queryResult))
         return errorList
 
+    def fetchErrorsBefore(self, errorId, limit, search=None):
+        """
+        Fetch up to limit errors older than errorId (or the newest errors if errorId is None), oldest first.
+
+        If search is given, only errors whose trace matches it in the search index are fetched.
+        """
+        if errorId is None:
+            errorId = LAST_ERROR_ID
+        queryResults = self._fetchErrorPage("errors.id < ?", errorId, "desc", limit, search)
+        return [Error(*queryResult) for queryResult in reversed(queryResults)]
+
+    def fetchErrorsAfter(self, errorId, limit, search=None):
+        """ Fetch up to limit errors newer than errorId (or the oldest errors if errorId is None), oldest first. """
+        if errorId is None:
+            errorId = 0
+        queryResults = self._fetchErrorPage("errors.id > ?", errorId, "asc", limit, search)
+        return [Error(*queryResult) for queryResult in queryResults]
+
+    def _fetchErrorPage(self, condition, errorId, order, limit, search):
+        """
+        Fetch the list rows of up to limit errors meeting condition, in errors.id order.
+
+        A search reads each matching trace's errors from errors_trace_id, which has them in id
+        order, through a cursor per trace, and merges the cursors as it goes. A page reads about
+        one index entry per matching trace plus the errors on it, however many errors there are.
+        """
+        if search is None:
+            return self._query(ERROR_LIST_QUERY + "where " + condition + " order by errors.id " + order + " limit ?;", errorId, limit)
+        traceQuery, params = self._matchingTracesQuery(search)
+        cursors = []
+        for (traceId,) in self._query(traceQuery + ";", *params):
+            cursor = self.conn.cursor()
+            cursor.execute(
+                "select errors.id from errors where errors.trace_id = ? and " + condition + " order by errors.id " + order + ";",
+                (traceId, errorId))
+            cursors.append(cursor)
+        try:
+            merged = heapq.merge(*cursors, reverse=order == "desc")
+            errorIds = [row[0] for row in itertools.islice(merged, limit)]
+        finally:
+            for cursor in cursors:
+                cursor.close()
+        if not errorIds:
+            return []
+        return self._query(
+            ERROR_LIST_QUERY + "where errors.id in (" + ",".join("?" * len(errorIds)) + ") order by errors.id " + order + ";", *errorIds)
+
+    def _matchingTracesQuery(self, search):
+        """ Build the query for the ids of the traces matching a search. """
+        conditions = []
+        params = []
+        words = []
+        for word in search.split():
+            match = TRACE_FILTER.match(word)
+            if match is None:
+                words.append(word)
+            elif match.group(1) == "at":
+                conditions.append(FRAME_FILTER)
+                params += [match.group(2), match.group(2) + ".", match.group(2) + "/"]
+            else:
+                conditions.append(ROOT_CAUSE_FILTER if match.group(1) == "root" else EXCEPTION_FILTER)
+                params += [match.group(2), match.group(2)]
+        if words:
+            conditions.append(SEARCH_FILTER)
+            params.append(toSearchQuery(" ".join(words)))
+        return MATCHING_TRACES_QUERY + " and ".join(conditions), params
+
+    def fetchDataVersion(self):
+        """ Return a value that changes whenever another connection commits to the database. """
+        return self._query("pragma data_version")[0][0]
+
     def fetchErrorDetail(self, errorId):
-        results = self._query("select full_error from errors where id = ? limit 1;", errorId)
+        results = self._query('''
+select traces.full_error, traces.encoding, traces.dictionary_id
+from errors join traces on traces.id = errors.trace_id
+where errors.id = ? limit 1;''', errorId)
         result = results[0]
-        return result[0]
+        return self._decodeTrace(*result)
+
+    def iterErrors(self, afterId=None, untilId=None, since=None, until=None, pageSize=1000):
+        """
+        Yield (error id, date, trace id, fingerprint, source, occurrences, short error, full error)
+        for the errors after afterId up to and including untilId, and from since until until, in id order.
+
+        Errors are read a page at a time starting after the last id of the page before (keyset
+        paging), so every page is a quick index lookup and memory use doesn't grow with the
+        number of errors. Each trace is decompressed once per page however many errors share it.
+        """
+        conditions = "errors.id > ? and errors.id <= ?"
+        params = [afterId or 0, untilId if untilId is not None else LAST_ERROR_ID]
+        if since is not None:
+            conditions += " and errors.date >= ?"
+            params.append(since)
+        if until is not None:
+            conditions += " and errors.date < ?"
+            params.append(until)
+        while True:
+            rows = self._query('''
+select errors.id, errors.date, traces.id, traces.fingerprint, errors.source, errors.occurrences,
+    traces.short_error, traces.full_error, traces.encoding, traces.dictionary_id
+from errors join traces on traces.id = errors.trace_id
+where ''' + conditions + " order by errors.id limit ?;", *params, pageSize)
+            fullErrors = {}
+            for errorId, date, traceId, fingerprint, source, occurrences, shortError, storedError, encoding, dictionaryId in rows:
+                if traceId not in fullErrors:
+                    fullErrors[traceId] = self._decodeTrace(storedError, encoding, dictionaryId)
+                yield (errorId, date, traceId, fingerprint, source, occurrences, shortError, fullErrors[traceId])
+            if len(rows) < pageSize:
+                return
+            params[0] = rows[-1][0]
+
+    def iterTopErrors(self, bucket, limit, since, until):
+        """ Yield (bucket, rank, trace id, count, short error, first seen, last seen) for the limit most common traces of each time bucket. """
+        return self._iterQuery('''
+select ranked.bucket, ranked.rank, traces.id, ranked.occurrences, traces.short_error, traces.first_seen, traces.last_seen
+from (
+    select bucket, trace_id, occurrences, row_number() over (partition by bucket order by occurrences desc, trace_id) as rank
+    from (
+        select strftime(?, date) as bucket, trace_id, sum(occurrences) as occurrences
+        from errors where date >= ? and date < ? group by bucket, trace_id
+    )
+) as ranked join traces on traces.id = ranked.trace_id
+where ranked.rank <= ? order by ranked.bucket, ranked.rank;''', REPORT_BUCKETS[bucket], since, until, limit)
+
+    def iterTraceSummary(self, since, until):
+        """ Yield (trace id, count, first seen, last seen, short error) for the traces seen between since and until, most common first. """
+        return self._iterQuery('''
+select id, count, first_seen, last_seen, short_error from traces
+where last_seen >= ? and first_seen < ? order by count desc, id;''', since, until)
+
+    def iterErrorRate(self, bucket, since, until):
+        """ Yield (bucket, count) for every time bucket with errors. """
+        return self._iterQuery('''
+select strftime(?, date) as bucket, sum(occurrences) from errors
+where date >= ? and date < ? group by bucket order by bucket;''', REPORT_BUCKETS[bucket], since, until)
+
+    def iterNewTraces(self, since, until):
+        """ Yield (trace id, first seen, last seen, count, short error) for the traces first seen between since and until. """
+        return self._iterQuery('''
+select id, first_seen, last_seen, count, short_error from traces
+where first_seen >= ? and first_seen < ? order by first_seen, id;''', since, until)
+
+    def pruneStep(self):
+        """
+        Delete one batch of errors past the retention limits and give some free pages back to the
+        file system. Returns True if there are more errors to delete.
+
+        Each batch is its own short transaction so parsers and viewers are never locked out for long.
+        """
+        errorIds = self._fetchExpiredErrorIds()
+        if errorIds:
+            self._withRetry(self._deleteErrors, errorIds)
+        self.vacuumStep()
+        return len(errorIds) == self.pruneBatchSize
+
+    def vacuumStep(self):
+        if self._query("pragma auto_vacuum")[0][0] == INCREMENTAL_VACUUM:
+            # execute would only step the pragma once, which frees a single page
+            self._withRetry(self.conn.executescript, "pragma incremental_vacuum(%d);" % self.vacuumPages)
+
+    def _fetchExpiredErrorIds(self):
+        if self.maxAge:
+            cutoff = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(time.time() - self.maxAge * 24 * 60 * 60))
+            errorIds = self._query("select id from errors where date < ? order by date limit ?", cutoff, self.pruneBatchSize)
+            if errorIds:
+                return [row[0] for row in errorIds]
+        if self.maxRows:
+            if self.lastExpiredId is None:
+                # the newest error that is one too many, everything up to it goes. Finding it walks
+                # maxRows index entries, so it is only looked for again once those errors are gone
+                lastExpired = self._query("select id from errors order by id desc limit 1 offset ?", self.maxRows)
+                if lastExpired:
+                    self.lastExpiredId = lastExpired[0][0]
+            if self.lastExpiredId is not None:
+                errorIds = self._query("select id from errors where id <= ? order by id limit ?", self.lastExpiredId, self.pruneBatchSize)
+                if len(errorIds) < self.pruneBatchSize:
+                    self.lastExpiredId = None
+                if errorIds:
+                    return [row[0] for row in errorIds]
+        if self.maxSize:
+            pageSize = self._query("pragma page_size")[0][0]
+            usedPages = self._query("pragma page_count")[0][0] - self._query("pragma freelist_count")[0][0]
+            if usedPages * pageSize > self.maxSize:
+                errorIds = self._query("select id from errors order by id limit ?", self.pruneBatchSize)
+                return [row[0] for row in errorIds]
+        return []
+
+    def _deleteErrors(self, errorIds):
+        """ Delete errors, and the traces no error uses any more. """
+        placeholders = ",".join("?" * len(errorIds))
+        self.cursor.execute("begin immediate")
+        try:
+            self.cursor.execute(
+                "select trace_id, sum(occurrences) from errors where id in (" + placeholders + ") group by trace_id", errorIds)
+            traceCounts = self.cursor.fetchall()
+            self.cursor.execute("delete from errors where id in (" + placeholders + ")", errorIds)
+            self.cursor.executemany("update traces set count = count - ? where id = ?", [(count, traceId) for traceId, count in traceCounts])
+            self.cursor.execute(
+                "select id, short_error, full_error, encoding, dictionary_id from traces where count <= 0 and id in (" +
+                ",".join("?" * len(traceCounts)) + ")", [traceId for traceId, count in traceCounts])
+            for traceId, shortError, storedError, encoding, dictionaryId in self.cursor.fetchall():
+                self._deleteTrace(traceId, shortError, self._decodeTrace(storedError, encoding, dictionaryId))
+            self.conn.commit()
+        except:
+            self.conn.rollback()
+            raise
+        finally:
+            # cached ids may belong to traces that were just deleted
+            self.traceIds.clear()
+
+    def _deleteTrace(self, traceId, shortError, fullError):
+        """ Delete a trace and take it out of the search and frame indexes. """
+        if self.canSearch:
+            # a contentless index needs the indexed text to take a row out
+            self.cursor.execute(
+                "insert into traces_fts (traces_fts, rowid, short_error, full_error) values ('delete', ?, ?, ?)",
+                (traceId, shortError, fullError))
+        self.cursor.execute("delete from trace_exceptions where trace_id = ?", (traceId,))
+        self._unindexFrames(traceId, fullError)
+        self.cursor.execute("delete from traces where id = ?", (traceId,))
+
+    def enableIncrementalVacuum(self):
+        """ Switch an older database to incremental vacuuming, this rewrites the whole file once. """
+        self.flush()
+        self.conn.isolation_level = None
+        try:
+            self.cursor.execute("pragma auto_vacuum = incremental")
+            self.cursor.execute("vacuum")
+        finally:
+            self.conn.isolation_level = ""
+
+    def _decodeTrace(self, storedError, encoding, dictionaryId):
+        return self.codec.decode(storedError, encoding, dictionaryId, self._fetchDictionary)
+
+    def _fetchDictionary(self, dictionaryId):
+        self.cursor.execute("select data from dictionaries where id = ?", (dictionaryId,))
+        return self.cursor.fetchone()[0]
+
+    def _useLatestDictionary(self):
+        results = self._query("select id, data from dictionaries order by id desc limit 1")
+        if results:
+            self.codec.dictionaryId, self.codec.dictionary = results[0]
+            self.codec.dictionaries[self.codec.dictionaryId] = self.codec.dictionary
+
+    def trainDictionary(self, sampleSize=2000):
+        """ Build a compression dictionary from the most recent traces and use it for new traces. """
+        texts = [self._decodeTrace(*row) for row in self._query(
+            "select full_error, encoding, dictionary_id from traces order by id desc limit ?", sampleSize)]
+        dictionary = trainDictionary(texts)
+        if not dictionary:
+            return None
+        self._withRetry(self._query, "insert into dictionaries (data) values (?)", dictionary)
+        self._useLatestDictionary()
+        return len(dictionary)
+
+    def recompressTraces(self, batchSize=500):
+        """ Store every trace again with the current compression settings, a batch per transaction. """
+        lastId = 0
+        count = 0
+        while True:
+            rows = self._query(
+                "select id, full_error, encoding, dictionary_id from traces where id > ? order by id limit ?", lastId, batchSize)
+            if not rows:
+                return count
+            updates = []
+            for traceId, storedError, encoding, dictionaryId in rows:
+                updates.append(self.codec.encode(self._decodeTrace(storedError, encoding, dictionaryId)) + (traceId,))
+            self._withRetry(self._updateTraces, updates)
+            lastId = rows[-1][0]
+            count += len(rows)
+
+    def _updateTraces(self, updates):
+        self.cursor.execute("begin immediate")
+        try:
+            self.cursor.executemany("update traces set full_error = ?, encoding = ?, dictionary_id = ? where id = ?", updates)
+            self.conn.commit()
+        except:
+            self.conn.rollback()
+            raise
 
 
 ######################
@@ -52,10 +807,16 @@ create table errors (
 ######################
 
 class Error(object):
-    def __init__(self, id, errorDatetime, shortError):
+    def __init__(self, id, errorDatetime, shortError, source=None, occurrences=1):
         self.id = id
         self.errorDatetime = errorDatetime
         self.shortError = shortError.strip()
+        self.source = source
+        self.occurrences = occurrences
 
     def getListText(self):
-        return self.errorDatetime + ": " + self.shortError
\ No newline at end of file
+        # a rate limited summary stands for all the occurrences it held back
+        shortError = self.shortError if self.occurrences == 1 else "(" + str(self.occurrences) + "x) " + self.shortError
+        if self.source:
+            return self.errorDatetime + " [" + self.source + "]: " + shortError
+        return self.errorDatetime + ": " + shortError
\ No newline at end of file
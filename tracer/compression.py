@@ -0,0 +1,83 @@
+import zlib
+from collections import Counter
+
+#########################################
+## COMPRESSES STORED STACK TRACE TEXTS ##
+#########################################
+
+# values of traces.encoding
+PLAIN_TEXT = 0
+ZLIB = 1
+
+# zlib only looks back 32KB, so a bigger dictionary would be wasted
+MAX_DICTIONARY_SIZE = 32 * 1024
+
+class TraceCodec(object):
+    """
+    Compresses trace texts with zlib, optionally primed with a shared dictionary.
+
+    Java traces repeat the same frames over and over, so a dictionary of common lines lets even
+    a short trace compress well. Each row records its encoding and dictionary, so rows written
+    with older settings (or before compression existed) can always be read back.
+    """
+
+    def __init__(self, enabled, level, dictionaryId=None, dictionary=None):
+        self.enabled = enabled
+        self.level = level
+        self.dictionaryId = dictionaryId
+        self.dictionary = dictionary
+        # dictionary id -> dictionary bytes, for reading rows written with older dictionaries
+        self.dictionaries = {}
+        if dictionaryId is not None:
+            self.dictionaries[dictionaryId] = dictionary
+
+    def encode(self, text):
+        """ Return (value, encoding, dictionaryId) to store for text. """
+        if not self.enabled or text is None:
+            return (text, PLAIN_TEXT, None)
+        data = text.encode("utf-8")
+        if self.dictionary is not None:
+            compressor = zlib.compressobj(self.level, zdict=self.dictionary)
+        else:
+            compressor = zlib.compressobj(self.level)
+        compressed = compressor.compress(data) + compressor.flush()
+        # tiny traces can come out bigger, those aren't worth compressing
+        if len(compressed) >= len(data):
+            return (text, PLAIN_TEXT, None)
+        return (compressed, ZLIB, self.dictionaryId)
+
+    def decode(self, value, encoding, dictionaryId, loadDictionary):
+        """ Turn a stored value back into text, loadDictionary(id) fetches dictionaries not seen yet. """
+        if encoding == PLAIN_TEXT or encoding is None:
+            return value
+        if encoding != ZLIB:
+            raise Exception("Unknown trace encoding " + str(encoding))
+        if dictionaryId is None:
+            return zlib.decompress(value).decode("utf-8")
+        if dictionaryId not in self.dictionaries:
+            self.dictionaries[dictionaryId] = loadDictionary(dictionaryId)
+        decompressor = zlib.decompressobj(zdict=self.dictionaries[dictionaryId])
+        return (decompressor.decompress(value) + decompressor.flush()).decode("utf-8")
+
+def trainDictionary(texts):
+    """
+    Build a compression dictionary from sample trace texts.
+
+    The dictionary is made of the most common lines, with the most common last since zlib
+    finds matches near the end of the dictionary most cheaply.
+    """
+    lineCounts = Counter()
+    for text in texts:
+        lineCounts.update(set(text.splitlines(True)))
+    lines = []
+    size = 0
+    for line, count in lineCounts.most_common():
+        # a line only seen once can't help any other trace
+        if count < 2:
+            break
+        data = line.encode("utf-8")
+        if size + len(data) > MAX_DICTIONARY_SIZE:
+            continue
+        lines.append(data)
+        size += len(data)
+    return b"".join(reversed(lines))
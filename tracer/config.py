@@ -27,6 +27,126 @@ _defaultConfig = """\
     backgroundErrorHighlightColor = black
     foregroundErrorHighlightColor = cyan
 
+    # how often in milliseconds the viewer checks for new errors in follow mode
+    followInterval = 1000
+
+    # opened errors kept in memory (by count and megabytes), and how many errors either side
+    # of an opened error are fetched in the background so n/p don't wait for the database
+    detailCacheSize = 100
+    detailCacheMemory = 64
+    prefetchNeighbors = 2
+
+# Database configuration
+[database]
+
+    # errors are queued and committed in a single transaction once batchSize
+    # errors are waiting or the oldest has waited batchInterval milliseconds
+    batchSize = 100
+    batchInterval = 1000
+
+    # sqlite journal mode and synchronous level (OFF, NORMAL, FULL or EXTRA)
+    journalMode = WAL
+    synchronous = NORMAL
+
+    # milliseconds to wait for another process to release the database lock, and how
+    # many more times a locked write is retried (with a growing delay) before giving up
+    busyTimeout = 5000
+    busyRetries = 5
+
+    # compress stored traces (zlib or none), optionally with a dictionary of common lines,
+    # run tracer.py dbFile --train-dictionary to build one from the traces already stored
+    compression = zlib
+    compressionLevel = 6
+    useDictionary = true
+
+    # split the database into a directory of shard files, one per day (day) or per shardRows
+    # errors (rows), with a manifest listing them. dbFile is then the directory, the viewer and
+    # reports read across the shards and retention deletes whole shards. none keeps one file
+    shardBy = none
+    shardRows = 1000000
+
+# How much history to keep, 0 turns a limit off. Errors past a limit are deleted in small
+# batches by the background writer and the freed space is given back with incremental
+# vacuuming. Databases created before this existed need tracer.py dbFile --vacuum once.
+[retention]
+
+    # days, number of errors, and megabytes
+    maxAge = 0
+    maxRows = 0
+    maxSize = 0
+
+    # seconds between checks, errors deleted per transaction and pages vacuumed per step
+    checkInterval = 60
+    batchSize = 1000
+    vacuumPages = 256
+
+# Background database writer configuration
+[writer]
+
+    # number of errors that can wait for the database before the overflow policy applies
+    queueSize = 10000
+
+    # what to do with new errors when the queue is full:
+    #   block - wait for the writer (slows down log passthrough)
+    #   dropOldest - throw away the oldest queued error
+    #   spill - append the error to spillFile and write it once the queue drains
+    overflow = block
+
+    # defaults to the database file name with .spill appended
+    spillFile =
+
+# Limits that keep memory use and database writes bounded however bad the input gets
+[limits]
+
+    # lines and kilobytes kept of a single error. The middle of a longer error is replaced by a
+    # line saying how much was left out, and lines are cut to half of maxErrorSize
+    maxErrorLines = 2000
+    maxErrorSize = 1024
+
+    # errors of each exception type stored per second once rateBurst of them have been stored
+    # (0 turns rate limiting off). Occurrences over the limit are counted, and stored as a summary
+    # row per trace and source with one of them as a sample. Which occurrences are stored in full
+    # then depends on how fast they arrive. Imported log files are never rate limited
+    ratePerSecond = 0
+    rateBurst = 100
+
+    # exception types rate limited at once, the one seen longest ago is forgotten first, and
+    # megabytes of samples held back at once before every summary is written early
+    maxTypes = 1000
+    maxHeldBack = 16
+
+# Importing log files with tracer.py dbFile --import FILE...
+[import]
+
+    # processes parsing in parallel (0 for one per core), megabytes of log per chunk
+    # handed to a process, and errors per transaction
+    workers = 0
+    chunkSize = 16
+    batchSize = 10000
+
+    # seconds a log file has to go unchanged before an error at its very end is imported, a file
+    # changed more recently may be in the middle of writing it and the next import reads it whole
+    settleTime = 60
+
+# Following log files with tracer.py dbFile --follow FILE...
+[follow]
+
+    # milliseconds between checks when inotify isn't available (and as a fallback when it is)
+    pollInterval = 1000
+
+    # read files that were never followed before from the start instead of only new lines
+    fromStart = false
+
+# Runtime metrics for the parser and database writer. When enabled, the stats are written as
+# a JSON line every statsInterval seconds and whenever tracer receives SIGUSR1.
+[metrics]
+
+    enabled = false
+
+    # file to append the stats to, stderr when empty, and seconds between them (0 for SIGUSR1 only)
+    statsFile =
+    statsInterval = 60
+
 # Regular expression patterns to exclude errors from being saved.
 # These patterns must match against the first line of the error message.
 [excludePatterns]
@@ -0,0 +1,96 @@
+import gzip
+import json
+import os
+import re
+import sys
+from tracer.report import writeCsv
+
+########################################
+## EXPORTS STORED ERRORS FOR ANALYSIS ##
+########################################
+
+EXPORT_COLUMNS = ("id", "date", "trace_id", "fingerprint", "source", "occurrences", "short_error", "full_error")
+
+def compilePatterns(patterns):
+    compiled = []
+    for pattern in patterns or ():
+        try:
+            compiled.append(re.compile(pattern, re.MULTILINE))
+        except re.error:
+            raise Exception("Error compiling regex " + pattern)
+    return compiled
+
+def readMark(markFile):
+    """ The id of the last error a previous export with this mark file read, or None. """
+    try:
+        with open(markFile) as f:
+            return json.load(f)["lastId"]
+    except FileNotFoundError:
+        return None
+
+def writeMark(markFile, lastId):
+    # replaced in one step, so an interrupted run leaves the old mark rather than half a file
+    temporaryPath = markFile + ".tmp"
+    with open(temporaryPath, "w") as f:
+        json.dump({"lastId": lastId}, f)
+    os.replace(temporaryPath, markFile)
+
+def openOutput(path):
+    """ Open the export file for text, gzip compressing it if the name ends in .gz, or stdout for -. """
+    if path == "-":
+        return sys.stdout
+    if path.endswith(".gz"):
+        return gzip.open(path, "wt", encoding="utf-8", newline="")
+    return open(path, "w", encoding="utf-8", newline="")
+
+def runExport(db, path, outputFormat="json", afterId=None, untilId=None, since=None, until=None,
+              include=None, exclude=None, markFile=None):
+    """
+    Write the stored errors with their full traces to path as JSON lines or CSV, returning the
+    number of errors written.
+
+    Errors are read in id order a page at a time and written as they come, so memory use stays
+    the same however many there are. Only errors whose trace matches one of the include patterns
+    (if any are given) and none of the exclude patterns are written. With a mark file, the id of
+    the last error read is saved in it once the export is complete and the next export with the
+    same mark file starts after it.
+    """
+    includePatterns = compilePatterns(include)
+    excludePatterns = compilePatterns(exclude)
+    if markFile is not None:
+        afterId = max(afterId or 0, readMark(markFile) or 0) or None
+    lastId = None
+
+    def exportedRows():
+        nonlocal lastId
+        for row in db.iterErrors(afterId, untilId, since, until):
+            lastId = row[0]
+            fullError = row[7]
+            if includePatterns and not any(pattern.search(fullError) for pattern in includePatterns):
+                continue
+            if any(pattern.search(fullError) for pattern in excludePatterns):
+                continue
+            yield row
+
+    output = openOutput(path)
+    try:
+        if outputFormat == "csv":
+            # the traces go out exactly as stored, as in JSON lines
+            count = writeCsv(output, EXPORT_COLUMNS, exportedRows(), clean=False)
+        else:
+            count = writeJsonLines(output, EXPORT_COLUMNS, exportedRows())
+    finally:
+        if output is sys.stdout:
+            output.flush()
+        else:
+            output.close()
+    if markFile is not None and lastId is not None:
+        writeMark(markFile, lastId)
+    return count
+
+def writeJsonLines(output, columns, rows):
+    count = 0
+    for row in rows:
+        output.write(json.dumps(dict(zip(columns, row))) + "\n")
+        count += 1
+    return count
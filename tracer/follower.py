@@ -0,0 +1,248 @@
+import ctypes
+import ctypes.util
+import glob
+import os
+import select
+import signal
+import sqlite3
+import sys
+import time
+from tracer.config import config
+from tracer.limiter import ErrorLimiter
+from tracer.parser import ErrorParser, READ_SIZE, splitLines
+
+############################################
+## FOLLOWS LOG FILES THE WAY TAIL -F DOES ##
+############################################
+
+# inotify_init1 flags and the events that can mean a followed file has something new
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+IN_MODIFY = 0x002
+IN_ATTRIB = 0x004
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+WATCH_EVENTS = IN_MODIFY | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+class Inotify(object):
+    """ Wakes the follower when something changes in the directories of the followed files (Linux only). """
+
+    def __init__(self, directories):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        for directory in directories:
+            if self.libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_EVENTS) < 0:
+                os.close(self.fd)
+                raise OSError(ctypes.get_errno(), "inotify_add_watch failed for " + directory)
+
+    def wait(self, timeout):
+        if select.select([self.fd], [], [], timeout)[0]:
+            # which file changed doesn't matter, every followed file gets checked
+            try:
+                while os.read(self.fd, 65536): pass
+            except BlockingIOError: pass
+
+    def close(self):
+        os.close(self.fd)
+
+class Polling(object):
+    """ Stands in for Inotify where it isn't available, every followed file is checked each interval. """
+
+    def wait(self, timeout):
+        time.sleep(timeout)
+
+    def close(self):
+        pass
+
+class FollowedFile(object):
+    """
+    A log file being followed, with its own parser so errors from different files never mix.
+
+    offset is how far complete lines have been parsed, and resumeOffset is where reading has to
+    start again after a restart: the start of an error still being read, since that error isn't
+    stored until it ends.
+    """
+
+    def __init__(self, db, path, sink):
+        self.db = db
+        self.path = path
+        self.parser = ErrorParser(sink, os.path.basename(path))
+        self.file = None
+        self.inode = None
+        self.offset = 0
+        self.errorStart = 0
+        self.partial = b""
+        # (inode, offset) last written to the database
+        self.committedCheckpoint = None
+
+    @property
+    def resumeOffset(self):
+        return self.errorStart if self.parser.errorBuffer else self.offset
+
+    def open(self, offset):
+        try:
+            self.file = open(self.path, "rb")
+        except FileNotFoundError:
+            return False
+        self.inode = os.fstat(self.file.fileno()).st_ino
+        self.file.seek(offset)
+        self.offset = offset
+        self.errorStart = offset
+        self.partial = b""
+        return True
+
+    def openAtCheckpoint(self, fromStart):
+        """ Open the file where it was left off, or at fromStart's end of it if it was never read. """
+        try:
+            fileStat = os.stat(self.path)
+        except FileNotFoundError:
+            return
+        checkpoint = self.db.fetchCheckpoint(self.path, fileStat.st_ino)
+        if checkpoint is not None and checkpoint[0] == fileStat.st_ino and checkpoint[1] <= fileStat.st_size:
+            self.open(checkpoint[1])
+        elif checkpoint is None and not fromStart:
+            self.open(fileStat.st_size)
+        else:
+            # replaced or truncated while tracer wasn't running
+            self.open(0)
+
+    def check(self):
+        """ Parse whatever was added to the file, switching to a new file if it was rotated. """
+        if self.file is None:
+            if self.open(0):
+                self.read()
+            return
+        self.read()
+        try:
+            fileStat = os.stat(self.path)
+        except FileNotFoundError:
+            # renamed away and the new file isn't there yet, keep reading the old one
+            return
+        if fileStat.st_ino != self.inode:
+            # rotated by renaming, read what was written to the old file since the read above
+            self.read()
+            self.finish()
+            self.file.close()
+            if self.open(0):
+                self.read()
+        elif fileStat.st_size < self.offset + len(self.partial):
+            # truncated in place (copytruncate), start again from the top
+            self.finish()
+            self.file.seek(0)
+            self.offset = 0
+            self.errorStart = 0
+            self.partial = b""
+            self.read()
+
+    def read(self):
+        while True:
+            block = self.file.read(READ_SIZE)
+            if not block:
+                break
+            lines, self.partial = splitLines(self.partial, block, self.parser.headMaxSize)
+            for rawLine in lines:
+                if self.parser.parseRawLine(rawLine) is not None and len(self.parser.errorBuffer) == 1:
+                    self.errorStart = self.offset
+                self.offset += len(rawLine)
+
+    def finish(self):
+        """ Store everything read from the current file, it won't get any more lines. """
+        if self.partial:
+            self.parser.parseRawLine(self.partial)
+            self.partial = b""
+        self.parser.flushError()
+        # the next file starts outside any error
+        self.parser.inError = False
+        self.parser.hasReadAt = False
+
+    def close(self):
+        # an error still being read is left for the next run, which starts again at its first line
+        if self.file is not None:
+            self.file.close()
+
+class FileFollower(object):
+    """
+    Follows log files like tail -F, saving the errors in them.
+
+    Files are checked whenever inotify reports a change in their directory, or every
+    pollInterval where inotify isn't available. A file renamed away by log rotation is read
+    to its end before the new file at its path is followed from the start, and a file
+    truncated in place is read again from the top. How far each file was read is committed in
+    the same transaction as its errors, so a restarted follower carries on where it stopped.
+    """
+
+    def __init__(self, db, patterns):
+        self.db = db
+        self.pollInterval = config.getint("follow", "pollInterval") / 1000
+        self.fromStart = config.getboolean("follow", "fromStart")
+        # commits are made here, together with the checkpoints they cover
+        self.batchSize = db.batchSize
+        self.batchInterval = db.batchInterval
+        db.batchSize = float("inf")
+        db.batchInterval = float("inf")
+        self.lastCommit = time.monotonic()
+        self.nextPrune = time.monotonic()
+        # error storms are rate limited, their summaries are committed like any other error
+        self.limiter = ErrorLimiter(db)
+        paths = []
+        for pattern in patterns:
+            for path in sorted(glob.glob(pattern)) or [pattern]:
+                if path not in paths:
+                    paths.append(path)
+        self.files = [FollowedFile(db, path, self.limiter) for path in paths]
+
+    def run(self):
+        for followedFile in self.files:
+            followedFile.openAtCheckpoint(self.fromStart)
+        # stop as cleanly on SIGTERM as on ctrl-c
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        try:
+            watcher = Inotify({os.path.dirname(os.path.abspath(followedFile.path)) for followedFile in self.files})
+        except (OSError, AttributeError):
+            watcher = Polling()
+        try:
+            while True:
+                for followedFile in self.files:
+                    followedFile.check()
+                self._commitIfDue()
+                self._pruneIfDue()
+                watcher.wait(self.pollInterval)
+        except KeyboardInterrupt: pass
+        finally:
+            watcher.close()
+            self._commit()
+            for followedFile in self.files:
+                followedFile.close()
+
+    def _commit(self):
+        # the checkpoints are past every occurrence held back so far, so their summaries go in the same commit
+        self.limiter.writeSummaries(force=True)
+        for followedFile in self.files:
+            if followedFile.file is None:
+                continue
+            checkpoint = (followedFile.inode, followedFile.resumeOffset)
+            # an idle file doesn't need its checkpoint written again
+            if checkpoint != followedFile.committedCheckpoint:
+                fileSize = os.fstat(followedFile.file.fileno()).st_size
+                self.db.setCheckpoint(followedFile.path, followedFile.inode, followedFile.resumeOffset, fileSize)
+                followedFile.committedCheckpoint = checkpoint
+        self.db.flush()
+        self.lastCommit = time.monotonic()
+
+    def _commitIfDue(self):
+        if len(self.db.pendingErrors) >= self.batchSize or time.monotonic() - self.lastCommit >= self.batchInterval:
+            self._commit()
+
+    def _pruneIfDue(self):
+        if not self.db.hasRetention or time.monotonic() < self.nextPrune:
+            return
+        try:
+            hasMore = self.db.pruneStep()
+        except sqlite3.Error as e:
+            print("tracer: could not prune old errors: " + str(e), file=sys.stderr)
+            hasMore = False
+        self.nextPrune = time.monotonic() + (0 if hasMore else config.getint("retention", "checkInterval"))
@@ -0,0 +1,247 @@
+import bz2
+import glob
+import gzip
+import lzma
+import mmap
+import os
+import re
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from tracer import parser
+from tracer.config import config
+
+###################################################
+## IMPORTS LARGE LOG FILES ACROSS MANY PROCESSES ##
+###################################################
+
+# rotated archives are decompressed as they are read
+COMPRESSED_OPENERS = {".gz": gzip.open, ".bz2": bz2.open, ".xz": lzma.open}
+
+# the date and time at the start of most log formats, e.g. 2026-01-01 00:33:05 or 2026-01-01T00:33:05
+LOG_TIMESTAMP = re.compile(r"(\d{4}-\d{2}-\d{2})[ T](\d{2}:\d{2}:\d{2})")
+
+def parseLogTimestamp(line):
+    """ Turn the local time a log line starts with into a UTC database timestamp, or None. """
+    match = LOG_TIMESTAMP.search(line, 0, 64)
+    if match is None:
+        return None
+    try:
+        localTime = time.mktime(time.strptime(match.group(1) + " " + match.group(2), "%Y-%m-%d %H:%M:%S"))
+    except (ValueError, OverflowError):
+        return None
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(localTime))
+
+def nextBoundary(data, pos):
+    """
+    The offset of the first line at or after pos that starts an error (excluded or not), or
+    the end of data.
+
+    A line starting an error resets the parser's state whatever came before it, so the lines
+    from one boundary to the next can be parsed on their own with the same result.
+    """
+    size = len(data)
+    if pos >= size:
+        return size
+    if pos > 0 and data[pos - 1:pos] != b"\n":
+        # move to the start of the next line
+        pos = data.find(b"\n", pos) + 1 or size
+    while pos < size:
+        found = data.find(b"ERROR", pos)
+        if found == -1:
+            return size
+        lineStart = max(pos, data.rfind(b"\n", pos, found) + 1)
+        lineEnd = data.find(b"\n", found) + 1 or size
+        line = data[lineStart:lineEnd].decode("utf-8", "replace")
+        if line.endswith("\r\n"):
+            line = line[:-2] + "\n"
+        if parser.CLASSIFIER.classify(line) in (parser.ERROR_START_LINE, parser.EXCLUDED_START_LINE):
+            return lineStart
+        pos = lineEnd
+    return size
+
+def findChunks(data, chunkSize, start=0):
+    """ Split data from start on into (start, end) ranges of about chunkSize bytes that begin at error boundaries. """
+    chunks = []
+    while start < len(data):
+        end = nextBoundary(data, start + chunkSize)
+        chunks.append((start, end))
+        start = end
+    return chunks
+
+class ChunkErrors(object):
+    """ Collects the errors parsed from a chunk in place of the database. """
+
+    def __init__(self):
+        self.errors = []
+
+    def addError(self, shortError, fullError, fingerprint, source=None):
+        self.errors.append((shortError, fullError, fingerprint, parseLogTimestamp(shortError)))
+
+def expandPaths(patterns):
+    """ Expand globs into the files to import, oldest first so rotated logs go in the order they were written. """
+    paths = []
+    for pattern in patterns:
+        matches = glob.glob(pattern)
+        if not matches and not os.path.isfile(pattern):
+            raise Exception("No log files match " + pattern)
+        for path in matches or [pattern]:
+            if path not in paths:
+                paths.append(path)
+    return sorted(paths, key=os.path.getmtime)
+
+def parseChunk(path, start, end, holdBack=False):
+    """
+    Parse the errors out of one chunk of a file, runs in a worker process. Returns the errors
+    and the offset the next import of the file starts at.
+
+    With holdBack, an error still going at the end of the chunk and a last line without a newline
+    are left for the next import, the file may still be being written.
+    """
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), end, access=mmap.ACCESS_READ) as data:
+        lines, partial = parser.splitLines(b"", data[start:end])
+    if partial and not holdBack:
+        lines.append(partial)
+    sink = ChunkErrors()
+    errorParser = parser.ErrorParser(sink)
+    offset = start
+    errorStart = start
+    for rawLine in lines:
+        if errorParser.parseRawLine(rawLine) is not None and len(errorParser.errorBuffer) == 1:
+            errorStart = offset
+        offset += len(rawLine)
+    if holdBack and errorParser.errorBuffer:
+        return sink.errors, errorStart
+    errorParser.flushError()
+    return sink.errors, offset
+
+class LogImporter(object):
+    """
+    Imports whole log files, parsing them in parallel.
+
+    Each plain file is memory mapped and split into chunks at lines that start errors, the chunks
+    are parsed by a pool of processes running the usual ErrorParser, and the errors are added to
+    the database in file order in large transactions. Compressed archives are decompressed and
+    parsed as a stream instead.
+
+    Errors keep the time from their log line, or the time of the error before them if their line
+    has none. Every transaction also records how far into the file it got, so importing a file
+    again only reads what was added to it since, and finished archives are skipped.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.workers = config.getint("import", "workers") or os.cpu_count() or 1
+        self.chunkSize = max(config.getint("import", "chunkSize"), 1) * 1024 * 1024
+        self.batchSize = max(config.getint("import", "batchSize"), 1)
+        self.settleTime = config.getint("import", "settleTime")
+        # only commit where a checkpoint can be recorded, so errors and checkpoints always agree
+        db.batchSize = float("inf")
+        db.batchInterval = float("inf")
+        self.lastDate = None
+
+    def importFiles(self, patterns):
+        """ Import each file matching the patterns in turn, returning the number of errors added. """
+        count = 0
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            for path in expandPaths(patterns):
+                count += self.importFile(executor, path)
+        return count
+
+    def importFile(self, executor, path):
+        fileStat = os.stat(path)
+        checkpoint = self.db.fetchCheckpoint(path, fileStat.st_ino)
+        if checkpoint is not None and checkpoint[0] != fileStat.st_ino:
+            # a new file took the path of the one read before
+            checkpoint = None
+        self.lastDate = None
+        opener = COMPRESSED_OPENERS.get(os.path.splitext(path)[1].lower())
+        if opener is not None:
+            count = self._importArchive(path, fileStat, opener, checkpoint)
+        else:
+            count = self._importMapped(executor, path, fileStat, checkpoint)
+        self.db.flush()
+        return count
+
+    def _addErrors(self, errors, source):
+        for shortError, fullError, fingerprint, date in errors:
+            self.lastDate = date or self.lastDate
+            self.db.addError(shortError, fullError, fingerprint, date=self.lastDate, source=source)
+        return len(errors)
+
+    def _commitUpTo(self, path, fileStat, offset, complete=False):
+        self.db.setCheckpoint(path, fileStat.st_ino, offset, fileStat.st_size, complete)
+        if len(self.db.pendingErrors) >= self.batchSize:
+            self.db.flush()
+
+    def _importMapped(self, executor, path, fileStat, checkpoint):
+        start = 0
+        if checkpoint is not None and checkpoint[1] <= fileStat.st_size:
+            # a file that shrank was truncated and is read again from the start
+            start = checkpoint[1]
+        if start >= fileStat.st_size:
+            return 0
+        # only up to the size seen above, so a file still being written ends where its checkpoint says
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), fileStat.st_size, access=mmap.ACCESS_READ) as data:
+            chunks = findChunks(data, self.chunkSize, start)
+        # a file changed lately may be in the middle of writing its last error
+        isSettled = time.time() - fileStat.st_mtime >= self.settleTime
+        source = os.path.basename(path)
+        count = 0
+        # only keep a few chunks in flight, so a slow database doesn't pile up parsed chunks in memory
+        pending = deque()
+        chunks = iter(chunks)
+        while True:
+            for start, end in chunks:
+                holdBack = end == fileStat.st_size and not isSettled
+                pending.append(executor.submit(parseChunk, path, start, end, holdBack))
+                if len(pending) >= self.workers * 2:
+                    break
+            if not pending:
+                break
+            errors, resumeOffset = pending.popleft().result()
+            count += self._addErrors(errors, source)
+            self._commitUpTo(path, fileStat, resumeOffset)
+        return count
+
+    def _importArchive(self, path, fileStat, opener, checkpoint):
+        """ Stream a compressed file through a parser, offsets count decompressed bytes. """
+        skip = 0
+        if checkpoint is not None and checkpoint[2] == fileStat.st_size:
+            if checkpoint[3]:
+                return 0
+            skip = checkpoint[1]
+        source = os.path.basename(path)
+        sink = ChunkErrors()
+        errorParser = parser.ErrorParser(sink)
+        count = 0
+        offset = 0
+        errorStart = 0
+        partial = b""
+        with opener(path, "rb") as stream:
+            while True:
+                block = stream.read(parser.READ_SIZE)
+                if not block:
+                    break
+                if skip:
+                    # the checkpoint is always at the start of a line
+                    skipped = min(skip, len(block))
+                    block = block[skipped:]
+                    offset += skipped
+                    skip -= skipped
+                lines, partial = parser.splitLines(partial, block, errorParser.headMaxSize)
+                for rawLine in lines:
+                    if errorParser.parseRawLine(rawLine) is not None and len(errorParser.errorBuffer) == 1:
+                        errorStart = offset
+                    offset += len(rawLine)
+                count += self._addErrors(sink.errors, source)
+                sink.errors[:] = []
+                # an error still being read isn't stored yet, so resuming has to read it again
+                self._commitUpTo(path, fileStat, errorStart if errorParser.errorBuffer else offset)
+        if partial:
+            errorParser.parseRawLine(partial)
+            offset += len(partial)
+        errorParser.flushError()
+        count += self._addErrors(sink.errors, source)
+        self._commitUpTo(path, fileStat, offset, complete=True)
+        return count
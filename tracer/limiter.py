@@ -0,0 +1,120 @@
+import random
+import time
+from collections import OrderedDict
+from tracer.config import config
+from tracer.parser import exceptionType
+
+############################################
+## RATE LIMITS ERROR STORMS PER EXCEPTION ##
+############################################
+
+class HeldBackErrors(object):
+    """ The occurrences of one trace from one source held back by a rate limit, and one of them as a sample. """
+
+    def __init__(self):
+        self.count = 0
+        self.sample = None
+        self.sampleSize = 0
+
+class ExceptionRate(object):
+    """ The token bucket of one exception type, and the occurrences it held back since its last summaries. """
+
+    def __init__(self, tokens, now):
+        self.tokens = tokens
+        self.updated = now
+        # (fingerprint, source) -> HeldBackErrors
+        self.heldBack = {}
+
+class ErrorLimiter(object):
+    """
+    Passes errors from parsers on to db, storing at most ratePerSecond of each exception type.
+
+    Every exception type (errors without a stack trace go by fingerprint) has a token bucket
+    holding up to rateBurst tokens, and storing an error takes one. Occurrences that find the
+    bucket empty are only counted, by trace and source, keeping one of each picked at random
+    as a sample. Once the type has a token again or the limiter is flushed, each trace and
+    source gets a summary row: its sample, stored with the number of occurrences it stands
+    for. Every summary row takes a token too, so however bad an error storm gets, each
+    exception type costs about ratePerSecond rows a second. Once the samples held back add up
+    to maxHeldBack megabytes, every summary is written early.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.rate = config.getfloat("limits", "ratePerSecond")
+        self.burst = max(config.getint("limits", "rateBurst"), 1)
+        self.maxTypes = max(config.getint("limits", "maxTypes"), 1)
+        self.maxHeldBackSize = config.getint("limits", "maxHeldBack") * 1024 * 1024
+        self.heldBackSize = 0
+        # exception type -> ExceptionRate, least recently seen first
+        self.rates = OrderedDict()
+        # the ExceptionRates with occurrences waiting for a summary
+        self.heldBack = {}
+
+    def addError(self, shortError, fullError, fingerprint, source=None):
+        if not self.rate:
+            self.db.addError(shortError, fullError, fingerprint, source=source)
+            return
+        key = exceptionType(fullError.split("\n")) or fingerprint
+        now = time.monotonic()
+        rate = self.rates.get(key)
+        if rate is None:
+            rate = self.rates[key] = ExceptionRate(self.burst, now)
+            if len(self.rates) > self.maxTypes:
+                # forget the type seen longest ago, writing what it held back first
+                oldestKey, oldest = self.rates.popitem(last=False)
+                if oldest.heldBack:
+                    self._writeSummaries(oldestKey, oldest)
+        else:
+            self.rates.move_to_end(key)
+            self._refill(rate, now)
+        if rate.heldBack and rate.tokens >= 1:
+            self._writeSummaries(key, rate)
+        if rate.tokens >= 1:
+            rate.tokens -= 1
+            self.db.addError(shortError, fullError, fingerprint, source=source)
+            return
+        heldBack = rate.heldBack.get((fingerprint, source))
+        if heldBack is None:
+            heldBack = rate.heldBack[(fingerprint, source)] = HeldBackErrors()
+        heldBack.count += 1
+        self.heldBack[key] = rate
+        # reservoir sampling, every held back occurrence is equally likely to be the sample
+        if random.randrange(heldBack.count) == 0:
+            sampleSize = len(shortError) + len(fullError)
+            self.heldBackSize += sampleSize - heldBack.sampleSize
+            heldBack.sample = (shortError, fullError)
+            heldBack.sampleSize = sampleSize
+            if self.heldBackSize > self.maxHeldBackSize:
+                self.writeSummaries(force=True)
+
+    def _refill(self, rate, now):
+        rate.tokens = min(self.burst, rate.tokens + (now - rate.updated) * self.rate)
+        rate.updated = now
+
+    def _writeSummaries(self, key, rate):
+        for (fingerprint, source), heldBack in rate.heldBack.items():
+            shortError, fullError = heldBack.sample
+            self.db.addError(shortError, fullError, fingerprint, source=source, occurrences=heldBack.count)
+            # a burst of summaries leaves the bucket in debt, so the type still averages ratePerSecond rows
+            rate.tokens -= 1
+            self.heldBackSize -= heldBack.sampleSize
+        rate.heldBack = {}
+        self.heldBack.pop(key, None)
+
+    def writeSummaries(self, force=False):
+        """ Write the summary rows of the types that have a token again, or of every type if force is set. """
+        now = time.monotonic()
+        for key, rate in list(self.heldBack.items()):
+            self._refill(rate, now)
+            if force or rate.tokens >= 1:
+                self._writeSummaries(key, rate)
+
+    def flushIfDue(self):
+        if self.heldBack:
+            self.writeSummaries()
+        self.db.flushIfDue()
+
+    def flush(self):
+        self.writeSummaries(force=True)
+        self.db.flush()
@@ -0,0 +1,178 @@
+import json
+import signal
+import sys
+import threading
+import time
+from tracer.config import config
+
+###################################
+## COUNTS AND TIMES THE PIPELINE ##
+###################################
+
+class Histogram(object):
+    """ Counts values into power of two buckets, enough for rough percentiles at a fixed cost. """
+
+    def __init__(self):
+        self.buckets = [0] * 64
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, value):
+        self.buckets[min(int(value).bit_length(), 63)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, fraction):
+        """ The upper bound of the bucket holding the given fraction of values. """
+        wanted = self.count * fraction
+        seen = 0
+        for bucket, bucketCount in enumerate(self.buckets):
+            seen += bucketCount
+            if seen >= wanted and bucketCount:
+                return min(2 ** bucket, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "total": self.total,
+            "mean": self.total / self.count if self.count else 0,
+            "p50": self.percentile(0.5),
+            "p95": self.percentile(0.95),
+            "p99": self.percentile(0.99),
+            "max": self.max,
+        }
+
+class Metrics(object):
+    """
+    Counters, timers (in microseconds) and size histograms for the ingest pipeline.
+
+    Nothing in the parser or database code knows about metrics. When metrics are enabled,
+    instrumentIngest wraps the methods worth watching, so with metrics disabled the hot paths
+    run exactly as they would without this module.
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self.timers = {}
+        self.sizes = {}
+        self.gauges = {}
+        self.started = time.time()
+
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def observeTime(self, name, seconds):
+        if name not in self.timers:
+            self.timers[name] = Histogram()
+        self.timers[name].add(seconds * 1000000)
+
+    def observeSize(self, name, size):
+        if name not in self.sizes:
+            self.sizes[name] = Histogram()
+        self.sizes[name].add(size)
+
+    def addGauge(self, name, read):
+        """ read() is called for the current value whenever the stats are dumped. """
+        self.gauges[name] = read
+
+    def wrap(self, owner, methodName, timerName=None, onCall=None):
+        """
+        Replace owner.methodName (a class or an instance) with a version that is timed into
+        timerName and/or passes its arguments and result to onCall(result, *args).
+        """
+        method = getattr(owner, methodName)
+        def wrapper(*args, **kwargs):
+            if timerName is None:
+                result = method(*args, **kwargs)
+            else:
+                start = time.perf_counter()
+                try:
+                    result = method(*args, **kwargs)
+                finally:
+                    self.observeTime(timerName, time.perf_counter() - start)
+            if onCall is not None:
+                onCall(result, *args, **kwargs)
+            return result
+        setattr(owner, methodName, wrapper)
+
+    def snapshot(self):
+        gauges = {}
+        for name, read in self.gauges.items():
+            try:
+                gauges[name] = read()
+            except Exception:
+                gauges[name] = None
+        return {
+            "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "uptime_seconds": time.time() - self.started,
+            "counters": dict(self.counters),
+            "timers_us": {name: histogram.summary() for name, histogram in list(self.timers.items())},
+            "sizes": {name: histogram.summary() for name, histogram in list(self.sizes.items())},
+            "gauges": gauges,
+        }
+
+    def dump(self, path=None):
+        line = json.dumps(self.snapshot(), sort_keys=True)
+        if path:
+            with open(path, "a") as statsFile:
+                statsFile.write(line + "\n")
+        else:
+            # stdout carries the log passthrough, stats go to stderr
+            print("tracer stats: " + line, file=sys.stderr, flush=True)
+
+    def startReporting(self, path, interval):
+        """ Dump the stats on SIGUSR1, and every interval seconds if interval isn't 0. """
+        if hasattr(signal, "SIGUSR1") and threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGUSR1, lambda signum, frame: self.dump(path))
+        if interval > 0:
+            def report():
+                while True:
+                    time.sleep(interval)
+                    self.dump(path)
+            threading.Thread(target=report, name="tracer-metrics", daemon=True).start()
+
+def instrumentIngest(metrics, db, sink):
+    """ Wrap the parser, classifier and database methods that make up the ingest pipeline. """
+    from tracer import parser
+    # parser: every line read goes through parseRawLine
+    metrics.wrap(parser.ErrorParser, "parseRawLine", onCall=lambda result, self, rawLine: metrics.count("linesRead"))
+    metrics.wrap(parser.ErrorParser, "parseError", "parseError")
+    # the buffer is emptied by flushError, so its size has to be taken before the call
+    flushError = parser.ErrorParser.flushError
+    def measuredFlushError(self):
+        if self.errorBuffer:
+            metrics.observeSize("errorLines", len(self.errorBuffer) + len(self.errorTail) + self.truncatedLines)
+        flushError(self)
+    parser.ErrorParser.flushError = measuredFlushError
+    # classifier: starts, exclusions and the cost of the exclude patterns
+    def countClass(lineClass, line):
+        if lineClass == parser.ERROR_START_LINE:
+            metrics.count("errorsStarted")
+        elif lineClass == parser.EXCLUDED_START_LINE:
+            metrics.count("errorsExcluded")
+    metrics.wrap(parser.CLASSIFIER, "classify", onCall=countClass)
+    metrics.wrap(parser.CLASSIFIER, "matchExclude", "isExcludedError")
+    # errors handed on for storage
+    def countStored(result, shortError, fullError, *args, **kwargs):
+        metrics.count("errorsFlushed")
+        metrics.count("bytesStored", len(fullError))
+    metrics.wrap(sink, "addError", onCall=countStored)
+    # database: queueing and commits
+    metrics.wrap(db, "addError", "addError")
+    metrics.wrap(db, "flush", "commit")
+    metrics.addGauge("pendingErrors", lambda: len(db.pendingErrors))
+    if hasattr(sink, "queue"):
+        metrics.addGauge("writerQueue", lambda: len(sink.queue))
+
+def startMetrics(db, sink):
+    """ Set up metrics for the ingest pipeline if [metrics] enables them, returning them or None. """
+    if not config.getboolean("metrics", "enabled"):
+        return None
+    metrics = Metrics()
+    instrumentIngest(metrics, db, sink)
+    metrics.startReporting(config["metrics"]["statsFile"].strip() or None, config.getint("metrics", "statsInterval"))
+    return metrics
@@ -1,90 +1,320 @@
+import hashlib
 import re
 import sys
+from collections import deque
 from tracer.config import config
 
-###########
-## UTILS ##
-###########
+##########################
+## CLASSIFIES LOG LINES ##
+##########################
 
-_excludePatterns = config["excludePatterns"]
-EXCLUDE_PATTERNS = []
-for key in _excludePatterns:
-    pattern = _excludePatterns[key]
-    try:
-        EXCLUDE_PATTERNS.append(re.compile(pattern))
-    except:
-        raise Exception("Error compiling regex " + key)
+PLAIN_LINE = 0
+ERROR_START_LINE = 1
+EXCLUDED_START_LINE = 2
+FRAME_LINE = 3
+CONTINUE_LINE = 4
+TERMINATOR_LINE = 5
+
+class LineClassifier(object):
+    """
+    Decides what part of an error a log line is in a single pass.
+
+    The exclude patterns are combined into a single alternation with a named group per pattern,
+    so excluding costs one regex search however many patterns there are, and the group that
+    matched says which pattern it was. Patterns that can't be combined (back references, inline
+    flags) are tried one at a time after the combined search.
+    """
+
+    def __init__(self, excludePatterns):
+        self.groupKeys = {}
+        self.separatePatterns = []
+        combinedPatterns = []
+        for key in excludePatterns:
+            pattern = excludePatterns[key]
+            try:
+                compiled = re.compile(pattern)
+            except:
+                raise Exception("Error compiling regex " + key)
+            groupName = "p" + str(len(self.groupKeys))
+            try:
+                # groups and back references would be renumbered once combined
+                if compiled.groups:
+                    raise re.error("pattern has groups")
+                re.compile("(?P<" + groupName + ">" + pattern + ")")
+            except re.error:
+                self.separatePatterns.append((key, compiled))
+                continue
+            self.groupKeys[groupName] = key
+            combinedPatterns.append("(?P<" + groupName + ">" + pattern + ")")
+        self.combinedPattern = re.compile("|".join(combinedPatterns)) if combinedPatterns else None
+
+    def matchExclude(self, line):
+        """ Return the key of the exclude pattern matching the line, or None. """
+        if self.combinedPattern is not None:
+            match = self.combinedPattern.search(line)
+            if match:
+                return self.groupKeys[match.lastgroup]
+        for key, pattern in self.separatePatterns:
+            if pattern.search(line):
+                return key
+        return None
+
+    def classify(self, line):
+        # cheap substring checks first, the regexes only run on the few lines that need them
+        if "ERROR" in line:
+            if self.matchExclude(line) is not None:
+                return EXCLUDED_START_LINE
+            return ERROR_START_LINE
+        if line.startswith("at "):
+            return FRAME_LINE
+        if line.startswith("<"):
+            return TERMINATOR_LINE
+        if line.startswith("Caused by: ") or not line.strip() or (" more" in line and ERROR_MORE.match(line)):
+            return CONTINUE_LINE
+        return PLAIN_LINE
+
+CLASSIFIER = LineClassifier(config["excludePatterns"])
 
 def isExcludedError(s):
-    for pattern in EXCLUDE_PATTERNS:
-        if (pattern.search(s)): return True
-    return False
+    return CLASSIFIER.matchExclude(s) is not None
+
+
+#################################
+## FINGERPRINTS AN ERROR TRACE ##
+#################################
+
+EXCEPTION_CLASS = re.compile(r"^(?:Caused by: )?([A-Za-z_$][\w$]*(?:\.[A-Za-z_$][\w$]*)+)(?::|$)")
+FRAME_LINE_NUMBER = re.compile(r"(\.\w+):\d+\)")
+HEX_ADDRESS = re.compile(r"0x[0-9a-fA-F]+")
+UUID = re.compile(r"[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}")
+NUMBER = re.compile(r"\d+")
+# the parts of class names the JVM and libraries make up at runtime: CGLIB and ByteBuddy class suffixes,
+# lambda classes, proxies, reflection accessors, and the numbers of anonymous classes and lambda methods
+GENERATED_ID = re.compile(
+    r"(\$\$\w*CGLIB\$\$|\$ByteBuddy\$|\$HibernateProxy\$)\w+"
+    r"|(\$\$Lambda)\$?\d*/(?:0x)?[0-9a-fA-F]+"
+    r"|(\$Proxy|jdk\.proxy|Generated\w*Accessor)\d+"
+    r"|\$\d+")
+# EXCEPTION_CLASS, and the method of an "at" line after any module or class loader (java.base/...),
+# for finding every match in a whole trace at once
+TRACE_EXCEPTION_CLASS = re.compile(r"^[ \t]*(?:Caused by: )?([A-Za-z_$][\w$]*(?:\.[A-Za-z_$][\w$]*)+)(?::|[ \t]*$)", re.MULTILINE)
+TRACE_FRAME_METHOD = re.compile(r"^[ \t]*at (?:[^\s(/]*/)*([^\s(/]+)", re.MULTILINE)
+
+def normalizeFrame(s):
+    """ Strip the parts of a stack frame that change between runs (line numbers, addresses, generated ids). """
+    s = FRAME_LINE_NUMBER.sub(r"\1)", s)
+    s = GENERATED_ID.sub(lambda match: match.group(1) or match.group(2) or match.group(3) or "$", s)
+    return HEX_ADDRESS.sub("0x", s)
 
+def normalizeMessage(s):
+    """ Strip the timestamp and any ids or numbers from an error line without a stack trace. """
+    errorPos = s.find("ERROR")
+    if errorPos >= 0:
+        s = s[errorPos:]
+    s = UUID.sub("#", s)
+    s = HEX_ADDRESS.sub("#", s)
+    return NUMBER.sub("#", s).strip()
 
-#############################
-## PARSES STDIN FOR ERRORS ##
-#############################
+def fingerprintError(lines):
+    """
+    Compute a fingerprint identifying all occurrences of the same error.
+
+    The fingerprint is built from the exception classes and normalized "at" frames of the trace,
+    so the same exception thrown from the same place always has the same fingerprint. Errors that
+    have no stack trace fall back to their normalized first line.
+    """
+    parts = []
+    for line in lines:
+        line = line.strip()
+        if line.startswith("at "):
+            parts.append(normalizeFrame(line))
+        elif not ERROR_MORE.match(line):
+            match = EXCEPTION_CLASS.match(line)
+            if match:
+                parts.append(match.group(1))
+    if not parts and lines:
+        parts.append(normalizeMessage(lines[0]))
+    return hashlib.sha1("\n".join(parts).encode("utf-8")).hexdigest()
+
+def parseTrace(text):
+    """
+    Pick the structure out of an error's text: its exception classes, outermost first and the
+    root cause last, and the methods its "at" frames are in (like java.lang.Thread.run).
+    """
+    return TRACE_EXCEPTION_CLASS.findall(text), TRACE_FRAME_METHOD.findall(text)
+
+def exceptionType(lines):
+    """ The class of the first exception in an error's lines, or None if it has no stack trace. """
+    for line in lines:
+        match = EXCEPTION_CLASS.match(line.strip())
+        if match:
+            return match.group(1)
+    return None
+
+
+###################################
+## PARSES LOG STREAMS FOR ERRORS ##
+###################################
 
-ERROR_START = re.compile(r".*?ERROR")
 ERROR_MORE = re.compile(r"^... [0-9]*? more$")
-BLANK_LINE = re.compile(r"^\s*$")
-class StdinParser(object):
-    def __init__(self, db):
+READ_SIZE = 1 << 16
+RESET_COLOR = b"\033[0;0m"
+# stands in for the middle of an error that was too long to keep
+TRUNCATED_MARKER = "... %d lines (%d bytes) left out ...\n"
+
+def splitLines(partial, block, maxLineSize=None):
+    """
+    Split a block of input into complete lines, returning them with the unfinished last line.
+
+    If maxLineSize is given, an unfinished line longer than that is returned as a line of its own
+    instead, so input without newlines can't pile up in memory.
+    """
+    lines = block.split(b"\n")
+    lines[0] = partial + lines[0]
+    partial = lines.pop()
+    lines = [line + b"\n" for line in lines]
+    if maxLineSize is not None and len(partial) > maxLineSize:
+        lines.append(partial)
+        partial = b""
+    return lines, partial
+
+class ErrorParser(object):
+    """
+    The state machine that picks errors out of a stream of log lines and hands them to db.
+
+    An error is kept to maxErrorLines lines and maxErrorSize kilobytes: the first half of each
+    goes in errorBuffer, and past that only the newest lines are kept in errorTail, so a runaway
+    error that never ends is stored with its head and its tail around a TRUNCATED_MARKER. Lines
+    are cut to half of maxErrorSize.
+    """
+    def __init__(self, db, source=None):
         self.db = db
+        self.source = source
         self.inError = False
-        self.hasReadException = False
+        self.hasReadAt = False
         self.errorBuffer = []
-        try:
-            for line in sys.stdin:
-                self.parseError(line)
-                if self.inError:
-                    self.printErrorLine(line)
-                else:
-                    self.printLogLine(line)
-        except KeyboardInterrupt: pass
-        finally:
-            self.flushError()
+        self.errorSize = 0
+        # (line, size) of the newest lines once errorBuffer is full
+        self.errorTail = deque()
+        self.tailSize = 0
+        self.truncatedLines = 0
+        self.truncatedSize = 0
+        maxErrorLines = max(config.getint("limits", "maxErrorLines"), 2)
+        maxErrorSize = max(config.getint("limits", "maxErrorSize"), 1) * 1024
+        self.headLines = maxErrorLines // 2
+        self.tailLines = maxErrorLines - self.headLines
+        self.headMaxSize = maxErrorSize // 2
+        self.tailMaxSize = maxErrorSize - self.headMaxSize
+
+    def parseRawLine(self, rawLine):
+        """ Parse an undecoded line, returning the decoded line if it is part of an error. """
+        # lines outside an error only need a look if they could start one
+        if not self.inError and b"ERROR" not in rawLine:
+            return None
+        line = rawLine.decode("utf-8", "replace")
+        if line.endswith("\r\n"):
+            line = line[:-2] + "\n"
+        self.parseError(line)
+        if not self.inError:
+            return None
+        self.bufferLine(line, len(rawLine))
+        return line
+
+    def bufferLine(self, line, size):
+        if size > self.headMaxSize:
+            line = line[:self.headMaxSize].rstrip("\n") + " ...\n"
+            size = len(line.encode("utf-8", "replace"))
+        # the first line always goes in errorBuffer, it is the error's short text
+        if not self.errorBuffer or (not self.errorTail and self.errorSize + size <= self.headMaxSize and len(self.errorBuffer) < self.headLines):
+            self.errorBuffer.append(line)
+            self.errorSize += size
+            return
+        # the head is full, keep the newest lines and count the ones that fall out of the middle
+        self.errorTail.append((line, size))
+        self.tailSize += size
+        while len(self.errorTail) > self.tailLines or self.tailSize > self.tailMaxSize:
+            droppedLine, droppedSize = self.errorTail.popleft()
+            self.tailSize -= droppedSize
+            self.truncatedLines += 1
+            self.truncatedSize += droppedSize
 
     def parseError(self, line):
-        if self.inError:
-            if line.startswith("<") or (self.hasReadAt and not self.isContinuePattern(line)):
-                self.flushError()
-                self.inError = False
-            self.hasReadAt = line.startswith("at ")
-            #if line.startswith("at ") and not self.hasReadAt:
-            #    self.hasReadAt = True
-        if ERROR_START.search(line):
-            if isExcludedError(line):
-                self.inError = False
-                return
+        lineClass = CLASSIFIER.classify(line)
+        if lineClass == ERROR_START_LINE:
             self.flushError()
-            # print("\n>>>>> ERROR START\n")
             self.inError = True
             self.hasReadAt = False
-
-    def isContinuePattern(self, line):
-        return \
-            line.startswith("at ") or \
-            line.startswith("Caused by: ") or \
-            ERROR_MORE.match(line) or \
-            BLANK_LINE.match(line)
+        elif lineClass == EXCLUDED_START_LINE:
+            if self.inError:
+                self.flushError()
+                self.inError = False
+        elif self.inError:
+            if lineClass == TERMINATOR_LINE or (self.hasReadAt and lineClass == PLAIN_LINE):
+                self.flushError()
+                self.inError = False
+            self.hasReadAt = lineClass == FRAME_LINE
 
     def flushError(self):
         if self.errorBuffer:
+            lines = self.errorBuffer
+            if self.errorTail:
+                tail = [line for line, size in self.errorTail]
+                lines = lines + ([TRUNCATED_MARKER % (self.truncatedLines, self.truncatedSize)] if self.truncatedLines else []) + tail
             shortErrorText = self.errorBuffer[0]
-            fullErrorText = ''.join(self.errorBuffer)
-            self.db.addError(shortErrorText, fullErrorText)
+            fullErrorText = ''.join(lines)
+            self.db.addError(shortErrorText, fullErrorText, fingerprintError(lines), source=self.source)
             self.errorBuffer[:] = [] # python clear list magic
+            self.errorSize = 0
+            self.errorTail.clear()
+            self.tailSize = 0
+            self.truncatedLines = 0
+            self.truncatedSize = 0
             # print("\n<<<<< ERROR END\n")
 
-    def printLogLine(self, line):
-        print(line, end="")
+class StdinParser(ErrorParser):
+    def __init__(self, db, input=None, output=None):
+        ErrorParser.__init__(self, db)
+        # raw byte streams, lines are only decoded when they may be part of an error
+        self.input = input if input is not None else sys.stdin.buffer
+        self.output = output if output is not None else sys.stdout.buffer
+        # resolve the config once instead of for every line
+        self.highlightErrors = config.getboolean("tracer", "highlightErrors")
+        # replace \\033 (string version) with \033 (character)
+        self.errorColor = config["tracer"]["errorColor"].replace("\\033", "\033").encode()
+        try:
+            for lines in self.readBlocks():
+                for rawLine in lines:
+                    if self.parseRawLine(rawLine) is None:
+                        self.printLogLine(rawLine)
+                    else:
+                        self.printErrorLine(rawLine)
+                # flush once per block so output isn't held back waiting for more input
+                self.output.flush()
+                self.db.flushIfDue()
+        except KeyboardInterrupt: pass
+        finally:
+            self.flushError()
+            self.output.flush()
+            self.db.flush()
+
+    def readBlocks(self):
+        """ Read the input in large blocks, yielding the complete lines in each block. """
+        partial = b""
+        while True:
+            # read1 returns whatever is available instead of waiting for a full block
+            block = self.input.read1(READ_SIZE)
+            if not block:
+                break
+            lines, partial = splitLines(partial, block, self.headMaxSize)
+            yield lines
+        if partial:
+            yield [partial]
+
+    def printLogLine(self, rawLine):
+        self.output.write(rawLine)
 
-    def printErrorLine(self, line):
-        self.errorBuffer.append(line)
-        if (config.getboolean("tracer", "highlightErrors")):
-            # replace \\033 (string version) with \033 (character)
-            errorColor = config["tracer"]["errorColor"].replace("\\033", "\033")
-            print(errorColor, line, "\033[0;0m", sep="", end="")
+    def printErrorLine(self, rawLine):
+        if self.highlightErrors:
+            self.output.write(self.errorColor + rawLine + RESET_COLOR)
         else:
-            print(line, end="")
\ No newline at end of file
+            self.output.write(rawLine)
@@ -0,0 +1,84 @@
+import csv
+import json
+import re
+import sys
+import time
+
+###########################################
+## REPORTS ON THE ERRORS IN THE DATABASE ##
+###########################################
+
+# report name -> the columns of its rows
+REPORTS = {
+    "top": ("bucket", "rank", "trace_id", "count", "short_error", "first_seen", "last_seen"),
+    "traces": ("trace_id", "count", "first_seen", "last_seen", "short_error"),
+    "rate": ("bucket", "count"),
+    "new": ("trace_id", "first_seen", "last_seen", "count", "short_error"),
+}
+
+RELATIVE_TIME = re.compile(r"^(\d+)([mhdw])$")
+RELATIVE_UNITS = {"m": 60, "h": 60 * 60, "d": 24 * 60 * 60, "w": 7 * 24 * 60 * 60}
+
+def parseReportTime(text):
+    """
+    Turn a report time into a database (UTC) timestamp. Times are either relative to now, like
+    30m, 12h, 1d or 2w, or UTC dates like 2026-01-31 or 2026-01-31 12:00:00.
+    """
+    text = text.strip()
+    match = RELATIVE_TIME.match(text)
+    if match:
+        seconds = int(match.group(1)) * RELATIVE_UNITS[match.group(2)]
+        return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(time.time() - seconds))
+    for timeFormat in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"):
+        try:
+            return time.strftime("%Y-%m-%d %H:%M:%S", time.strptime(text, timeFormat))
+        except ValueError: pass
+    raise Exception("Invalid report time: " + text)
+
+def runReport(db, name, outputFormat="json", bucket="day", limit=10, since=None, until=None, output=None):
+    """
+    Write a report to output (stdout by default) as a JSON array or CSV, returning the row count.
+
+    Rows are written as the database produces them, so a report over any number of errors runs
+    in bounded memory. Without since, "new" covers the last day and the others all of time.
+    """
+    if since is None:
+        since = parseReportTime("1d") if name == "new" else "0000-00-00"
+    if until is None:
+        until = "9999-12-31"
+    if name == "top":
+        rows = db.iterTopErrors(bucket, limit, since, until)
+    elif name == "traces":
+        rows = db.iterTraceSummary(since, until)
+    elif name == "rate":
+        rows = db.iterErrorRate(bucket, since, until)
+    else:
+        rows = db.iterNewTraces(since, until)
+    output = output if output is not None else sys.stdout
+    if outputFormat == "csv":
+        return writeCsv(output, REPORTS[name], rows)
+    return writeJson(output, REPORTS[name], rows)
+
+def cleanValue(value):
+    # a short error is its first log line, newline included
+    return value.rstrip("\n") if isinstance(value, str) else value
+
+def writeCsv(output, columns, rows, clean=True):
+    """ Write rows as CSV, with the trailing newline of short errors taken off unless clean is False. """
+    writer = csv.writer(output)
+    writer.writerow(columns)
+    count = 0
+    for row in rows:
+        writer.writerow([cleanValue(value) for value in row] if clean else row)
+        count += 1
+    return count
+
+def writeJson(output, columns, rows):
+    output.write("[")
+    count = 0
+    for row in rows:
+        output.write(",\n " if count else "\n ")
+        output.write(json.dumps(dict(zip(columns, (cleanValue(value) for value in row)))))
+        count += 1
+    output.write("\n]\n" if count else "]\n")
+    return count
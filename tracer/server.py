@@ -0,0 +1,109 @@
+import asyncio
+import os
+import signal
+import stat
+from tracer.config import config
+from tracer.parser import ErrorParser, READ_SIZE, splitLines
+
+##############################################
+## COLLECTS LOG STREAMS FROM MANY PRODUCERS ##
+##############################################
+
+# a client can name itself by sending this followed by the name as its first line
+SOURCE_HEADER = b"TRACER-SOURCE "
+
+def parseAddress(address):
+    """
+    Parse a listen address into ("unix", path) or ("tcp", (host, port)).
+
+    Addresses are either unix:PATH, tcp:HOST:PORT, HOST:PORT or just PORT.
+    """
+    if address.startswith("unix:"):
+        return ("unix", address[len("unix:"):])
+    if address.startswith("tcp:"):
+        address = address[len("tcp:"):]
+    host, sep, port = address.rpartition(":")
+    if not port.isdigit():
+        raise Exception("Invalid listen address: " + address)
+    return ("tcp", (host.strip("[]") or None, int(port)))
+
+class TraceServer(object):
+    """
+    Listens on unix and tcp sockets for log streams and parses each one for errors.
+
+    Every connection gets its own ErrorParser, so interleaved streams never mix their errors,
+    and every parser hands its errors to the same db (normally a single ErrorWriter). Errors are
+    tagged with the name the client sent in a TRACER-SOURCE line, or with its host otherwise.
+    db is flushed when due every batchInterval, so errors held back by a rate limit are written
+    even when no more arrive.
+    """
+
+    def __init__(self, db, addresses):
+        self.db = db
+        self.addresses = [parseAddress(address) for address in addresses]
+
+    def run(self):
+        try:
+            asyncio.run(self._serve())
+        except (KeyboardInterrupt, asyncio.CancelledError): pass
+        finally:
+            self.db.flush()
+
+    async def _serve(self):
+        servers = []
+        unixPaths = []
+        # stop as cleanly on SIGTERM as on ctrl-c
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+        try:
+            for kind, target in self.addresses:
+                if kind == "unix":
+                    removeStaleSocket(target)
+                    servers.append(await asyncio.start_unix_server(self._handleClient, path=target))
+                    unixPaths.append(target)
+                else:
+                    host, port = target
+                    servers.append(await asyncio.start_server(self._handleClient, host, port))
+            await asyncio.gather(self._flushPeriodically(), *(server.serve_forever() for server in servers))
+        finally:
+            for server in servers:
+                server.close()
+            for path in unixPaths:
+                removeStaleSocket(path)
+
+    async def _flushPeriodically(self):
+        interval = config.getint("database", "batchInterval") / 1000
+        while True:
+            await asyncio.sleep(interval)
+            self.db.flushIfDue()
+
+    async def _handleClient(self, reader, writer):
+        peer = writer.get_extra_info("peername")
+        source = peer[0] if isinstance(peer, tuple) else "local"
+        parser = ErrorParser(self.db, source)
+        partial = b""
+        isFirstLine = True
+        try:
+            while True:
+                block = await reader.read(READ_SIZE)
+                if not block:
+                    break
+                lines, partial = splitLines(partial, block, parser.headMaxSize)
+                for rawLine in lines:
+                    if isFirstLine:
+                        isFirstLine = False
+                        if rawLine.startswith(SOURCE_HEADER):
+                            parser.source = rawLine[len(SOURCE_HEADER):].decode("utf-8", "replace").strip() or source
+                            continue
+                    parser.parseRawLine(rawLine)
+            if partial:
+                parser.parseRawLine(partial)
+        except ConnectionError: pass
+        finally:
+            parser.flushError()
+            writer.close()
+
+def removeStaleSocket(path):
+    try:
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            os.remove(path)
+    except FileNotFoundError: pass
@@ -0,0 +1,448 @@
+import fcntl
+import json
+import os
+import time
+from tracer.common import DBManager, REPORT_BUCKETS, currentTimestamp
+from tracer.config import config
+
+###################################################
+## SPLITS THE ERRORS OVER TIME PARTITIONED FILES ##
+###################################################
+
+MANIFEST_NAME = "manifest.json"
+SHARD_MODES = ("none", "day", "rows")
+
+# a global error or trace id is the shard's sequence number followed by the id within the shard
+SHARD_ID_BITS = 40
+LOCAL_ID_MASK = (1 << SHARD_ID_BITS) - 1
+
+def globalId(seq, localId):
+    return (seq << SHARD_ID_BITS) | localId
+
+def splitId(errorId):
+    """ Split a global id into (shard sequence number, id within the shard). """
+    return (errorId >> SHARD_ID_BITS, errorId & LOCAL_ID_MASK)
+
+# per shard parts of the reports, merged across shards by fingerprint
+BUCKET_COUNTS_QUERY = '''
+select counts.bucket, traces.fingerprint, traces.id, counts.occurrences, traces.short_error, traces.first_seen, traces.last_seen
+from (
+    select strftime(?, date) as bucket, trace_id, sum(occurrences) as occurrences
+    from errors where date >= ? and date < ? group by bucket, trace_id
+) as counts join traces on traces.id = counts.trace_id;'''
+TRACE_TOTALS_QUERY = '''
+select fingerprint, id, count, short_error, first_seen, last_seen from traces
+where last_seen >= ? and first_seen < ?;'''
+NEW_TRACES_QUERY = '''
+select fingerprint, id, count, short_error, first_seen, last_seen from traces
+where first_seen >= ? and first_seen < ?;'''
+
+def openDB(file, readOnly=False):
+    """ Open file as a DBManager, or as a ShardedDB if it is a shard directory or [database] shardBy is set. """
+    if os.path.isdir(file) or config["database"]["shardBy"].strip().lower() != "none":
+        return ShardedDB(file, readOnly)
+    return DBManager(file, readOnly)
+
+class Manifest(object):
+    """
+    The list of shards in a shard directory, kept as a small JSON file.
+
+    Every shard records its sequence number, file name, day (when sharding by day), the first and
+    last error dates in it and its row count. Writers change it under an exclusive lock and
+    replace it atomically, so readers never see half of it.
+    """
+
+    def __init__(self, directory):
+        self.path = os.path.join(directory, MANIFEST_NAME)
+        self.shardBy = None
+        self.shards = []
+        self.version = None
+
+    def refresh(self):
+        """ Reload the manifest if another process changed it, returning True if it did. """
+        try:
+            fileStat = os.stat(self.path)
+        except FileNotFoundError:
+            return False
+        version = (fileStat.st_mtime_ns, fileStat.st_size, fileStat.st_ino)
+        if version == self.version:
+            return False
+        with open(self.path) as manifestFile:
+            data = json.load(manifestFile)
+        self.shardBy = data["shardBy"]
+        self.shards = data["shards"]
+        self.version = version
+        return True
+
+    def update(self, change):
+        """ Apply change(manifest) to the latest manifest and save it, holding the lock throughout. """
+        with open(self.path + ".lock", "a") as lockFile:
+            fcntl.flock(lockFile, fcntl.LOCK_EX)
+            self.refresh()
+            change(self)
+            temporaryPath = self.path + ".tmp"
+            with open(temporaryPath, "w") as manifestFile:
+                json.dump({"shardBy": self.shardBy, "shards": self.shards}, manifestFile, indent=1)
+            os.replace(temporaryPath, self.path)
+            self.version = None
+            self.refresh()
+
+    def findShard(self, seq):
+        for shard in self.shards:
+            if shard["seq"] == seq:
+                return shard
+        return None
+
+class ShardedDB(object):
+    """
+    Stores errors in a directory of shard databases, one per day or per shardRows errors.
+
+    It has the same methods as DBManager, so the writer, parsers, viewer and reports use it the
+    same way. Errors are queued here and each batch is split over the shards it belongs in.
+    Reads go through the shards newest or oldest first until enough errors are found, and
+    reports skip the shards outside their time range. Expiring old errors deletes whole shards.
+
+    Errors and traces are numbered with global ids (see globalId), so ids from different shards
+    never clash. A trace seen in several shards has a row in each, reports merge them by
+    fingerprint. Import and follow checkpoints live in the newest shard.
+    """
+
+    def __init__(self, directory, readOnly=False):
+        self.file = directory.rstrip(os.sep) or directory
+        self.readOnly = readOnly
+        self.manifest = Manifest(self.file)
+        if not readOnly:
+            os.makedirs(self.file, exist_ok=True)
+        if not self.manifest.refresh():
+            shardBy = config["database"]["shardBy"].strip().lower()
+            if shardBy not in SHARD_MODES:
+                raise Exception("Invalid value for shardBy: " + shardBy)
+            if shardBy == "none":
+                raise Exception(self.file + " is not a shard directory, set shardBy in [database] to create one")
+            if not readOnly:
+                self.manifest.update(lambda manifest: setattr(manifest, "shardBy", shardBy))
+        self.shardRows = config.getint("database", "shardRows")
+        # seq -> open DBManager
+        self.databases = {}
+        # queued like DBManager's, see DBManager.addError
+        self.batchSize = config.getint("database", "batchSize")
+        self.batchInterval = config.getint("database", "batchInterval") / 1000
+        self.pendingErrors = []
+        self.pendingSince = None
+        self.pendingCheckpoints = {}
+        # retention deletes whole shards
+        self.maxAge = config.getint("retention", "maxAge")
+        self.maxRows = config.getint("retention", "maxRows")
+        self.maxSize = config.getint("retention", "maxSize") * 1024 * 1024
+        self.hasRetention = bool(self.maxAge or self.maxRows or self.maxSize)
+
+    @property
+    def canSearch(self):
+        return all(self._open(shard["seq"]).canSearch for shard in self._shards())
+
+    def _shards(self):
+        """ The shards that still exist, oldest sequence number first. """
+        if self.manifest.refresh():
+            # forget shards that were expired
+            for seq in list(self.databases):
+                if self.manifest.findShard(seq) is None:
+                    self.databases.pop(seq).close()
+        return sorted(self.manifest.shards, key=lambda shard: shard["seq"])
+
+    def _shardsBetween(self, since, until):
+        return [shard for shard in self._shards() if shard["last"] >= since and shard["first"] < until]
+
+    def _open(self, seq):
+        if seq not in self.databases:
+            shard = self.manifest.findShard(seq)
+            self.databases[seq] = DBManager(os.path.join(self.file, shard["file"]), self.readOnly)
+        return self.databases[seq]
+
+    def close(self):
+        self.flush()
+        for db in self.databases.values():
+            db.close()
+        self.databases.clear()
+
+
+    def addError(self, shortError, fullError, fingerprint, date=None, source=None, occurrences=1):
+        if date is None:
+            date = currentTimestamp()
+        if not self.pendingErrors:
+            self.pendingSince = time.monotonic()
+        self.pendingErrors.append((date, shortError, fullError, fingerprint, source, occurrences))
+        if len(self.pendingErrors) >= self.batchSize:
+            self.flush()
+        else:
+            self.flushIfDue()
+
+    def flushIfDue(self):
+        if self.pendingErrors and time.monotonic() - self.pendingSince >= self.batchInterval:
+            self.flush()
+
+    def setCheckpoint(self, path, inode, offset, fileSize, complete=False):
+        self.pendingCheckpoints[path] = (inode, offset, fileSize, complete)
+
+    def fetchCheckpoint(self, path, inode):
+        # the newest shard holding any checkpoint for the file has the latest one
+        for shard in reversed(self._shards()):
+            checkpoint = self._open(shard["seq"]).fetchCheckpoint(path, inode)
+            if checkpoint is not None:
+                return checkpoint
+        return None
+
+    def flush(self):
+        """ Write the queued errors, one transaction per shard, with the checkpoints going in last. """
+        if not self.pendingErrors and not self.pendingCheckpoints:
+            return
+        groups = {}
+        for error in self.pendingErrors:
+            groups.setdefault(self._shardFor(error[0], groups), []).append(error)
+        if self.pendingCheckpoints:
+            newestSeq = max([shard["seq"] for shard in self.manifest.shards] or [self._createShard(currentTimestamp())])
+            groups.setdefault(newestSeq, [])
+        for seq in sorted(groups):
+            db = self._open(seq)
+            db.pendingErrors.extend(groups[seq])
+            if seq == max(groups):
+                db.pendingCheckpoints.update(self.pendingCheckpoints)
+            try:
+                db.flush()
+            except:
+                db.pendingErrors[:] = []
+                db.pendingCheckpoints.clear()
+                raise
+            # only what wasn't written yet stays queued if a later shard fails
+            written = set(map(id, groups[seq]))
+            self.pendingErrors[:] = [error for error in self.pendingErrors if id(error) not in written]
+            self._recordRows(seq, groups[seq])
+        self.pendingErrors[:] = []
+        self.pendingSince = None
+        self.pendingCheckpoints.clear()
+
+    def _shardFor(self, date, groups):
+        """ The sequence number of the shard an error from date goes in, creating it if needed. """
+        self._shards()
+        if self.manifest.shardBy == "day":
+            for shard in self.manifest.shards:
+                if shard["day"] == date[:10]:
+                    return shard["seq"]
+            return self._createShard(date)
+        if self.manifest.shards:
+            newest = max(self.manifest.shards, key=lambda shard: shard["seq"])
+            if newest["rows"] + len(groups.get(newest["seq"], ())) < self.shardRows:
+                return newest["seq"]
+        return self._createShard(date)
+
+    def _createShard(self, date):
+        created = []
+        def addShard(manifest):
+            if manifest.shardBy == "day":
+                # another process may have created it in the meantime
+                for shard in manifest.shards:
+                    if shard["day"] == date[:10]:
+                        created.append(shard["seq"])
+                        return
+            seq = max([shard["seq"] for shard in manifest.shards] or [0]) + 1
+            if manifest.shardBy == "day":
+                fileName = date[:10] + ".db"
+            else:
+                fileName = "shard-%06d.db" % seq
+            manifest.shards.append({"seq": seq, "file": fileName, "day": date[:10], "first": date, "last": date, "rows": 0})
+            created.append(seq)
+        self.manifest.update(addShard)
+        return created[0]
+
+    def _recordRows(self, seq, errors):
+        if not errors:
+            return
+        first = min(error[0] for error in errors)
+        last = max(error[0] for error in errors)
+        def record(manifest):
+            shard = manifest.findShard(seq)
+            if shard is not None:
+                shard["rows"] += len(errors)
+                shard["first"] = min(shard["first"], first)
+                shard["last"] = max(shard["last"], last)
+        self.manifest.update(record)
+
+
+    def pruneStep(self):
+        """ Delete the oldest shards past the retention limits, the newest shard is always kept. """
+        shards = sorted(self._shards(), key=lambda shard: (shard["last"], shard["seq"]))[:-1]
+        expired = []
+        if self.maxAge:
+            cutoff = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(time.time() - self.maxAge * 24 * 60 * 60))
+            expired += [shard for shard in shards if shard["last"] < cutoff]
+        if self.maxRows:
+            rows = sum(shard["rows"] for shard in self.manifest.shards)
+            for shard in shards:
+                if rows <= self.maxRows:
+                    break
+                expired.append(shard)
+                rows -= shard["rows"]
+        if self.maxSize:
+            size = sum(self._fileSize(shard) for shard in self.manifest.shards)
+            for shard in shards:
+                if size <= self.maxSize:
+                    break
+                expired.append(shard)
+                size -= self._fileSize(shard)
+        if expired:
+            self._deleteShards({shard["seq"] for shard in expired})
+        return False
+
+    def _fileSize(self, shard):
+        try:
+            return os.path.getsize(os.path.join(self.file, shard["file"]))
+        except FileNotFoundError:
+            return 0
+
+    def _deleteShards(self, seqs):
+        removed = []
+        def remove(manifest):
+            removed.extend(shard for shard in manifest.shards if shard["seq"] in seqs)
+            manifest.shards = [shard for shard in manifest.shards if shard["seq"] not in seqs]
+        self.manifest.update(remove)
+        for shard in removed:
+            if shard["seq"] in self.databases:
+                self.databases.pop(shard["seq"]).close()
+            for suffix in ("", "-wal", "-shm"):
+                try:
+                    os.remove(os.path.join(self.file, shard["file"]) + suffix)
+                except FileNotFoundError: pass
+
+
+    def fetchErrors(self):
+        errors = []
+        for shard in self._shards():
+            errors.extend(self._globalErrors(shard["seq"], self._open(shard["seq"]).fetchErrors()))
+        return errors
+
+    def fetchErrorsBefore(self, errorId, limit, search=None):
+        startSeq, localId = splitId(errorId) if errorId is not None else (float("inf"), None)
+        errors = []
+        for shard in reversed(self._shards()):
+            seq = shard["seq"]
+            if seq > startSeq:
+                continue
+            page = self._open(seq).fetchErrorsBefore(localId if seq == startSeq else None, limit - len(errors), search)
+            errors[0:0] = self._globalErrors(seq, page)
+            if len(errors) >= limit:
+                break
+        return errors
+
+    def fetchErrorsAfter(self, errorId, limit, search=None):
+        startSeq, localId = splitId(errorId) if errorId is not None else (0, None)
+        errors = []
+        for shard in self._shards():
+            seq = shard["seq"]
+            if seq < startSeq:
+                continue
+            page = self._open(seq).fetchErrorsAfter(localId if seq == startSeq else None, limit - len(errors), search)
+            errors.extend(self._globalErrors(seq, page))
+            if len(errors) >= limit:
+                break
+        return errors
+
+    def _globalErrors(self, seq, errors):
+        for error in errors:
+            error.id = globalId(seq, error.id)
+        return errors
+
+    def fetchErrorDetail(self, errorId):
+        seq, localId = splitId(errorId)
+        self._shards()
+        return self._open(seq).fetchErrorDetail(localId)
+
+    def iterErrors(self, afterId=None, untilId=None, since=None, until=None, pageSize=1000):
+        afterSeq, afterLocalId = splitId(afterId) if afterId else (0, None)
+        untilSeq, untilLocalId = splitId(untilId) if untilId is not None else (float("inf"), None)
+        for shard in self._shardsBetween(since or "", until or "9999-12-31"):
+            seq = shard["seq"]
+            if seq < afterSeq or seq > untilSeq:
+                continue
+            rows = self._open(seq).iterErrors(
+                afterLocalId if seq == afterSeq else None, untilLocalId if seq == untilSeq else None, since, until, pageSize)
+            for row in rows:
+                yield (globalId(seq, row[0]), row[1], globalId(seq, row[2])) + row[3:]
+
+    def fetchDataVersion(self):
+        # every write updates the manifest, so it changing is enough to know there are new errors
+        self.manifest.refresh()
+        return self.manifest.version
+
+
+    def iterTopErrors(self, bucket, limit, since, until):
+        counts = {}
+        traces = {}
+        for shard in self._shardsBetween(since, until):
+            rows = self._open(shard["seq"])._iterQuery(BUCKET_COUNTS_QUERY, REPORT_BUCKETS[bucket], since, until)
+            for bucketName, fingerprint, traceId, occurrences, shortError, firstSeen, lastSeen in rows:
+                counts[(bucketName, fingerprint)] = counts.get((bucketName, fingerprint), 0) + occurrences
+                self._mergeTrace(traces, shard["seq"], fingerprint, traceId, 0, shortError, firstSeen, lastSeen)
+        byBucket = {}
+        for (bucketName, fingerprint), occurrences in counts.items():
+            byBucket.setdefault(bucketName, []).append((occurrences, fingerprint))
+        for bucketName in sorted(byBucket):
+            ranked = sorted(byBucket[bucketName], key=lambda item: (-item[0], traces[item[1]][0]))[:limit]
+            for rank, (occurrences, fingerprint) in enumerate(ranked, 1):
+                traceId, count, shortError, firstSeen, lastSeen = traces[fingerprint]
+                yield (bucketName, rank, traceId, occurrences, shortError, firstSeen, lastSeen)
+
+    def iterTraceSummary(self, since, until):
+        traces = self._mergedTraces(TRACE_TOTALS_QUERY, since, until)
+        for traceId, count, shortError, firstSeen, lastSeen in sorted(traces.values(), key=lambda trace: (-trace[1], trace[0])):
+            yield (traceId, count, firstSeen, lastSeen, shortError)
+
+    def iterErrorRate(self, bucket, since, until):
+        counts = {}
+        for shard in self._shardsBetween(since, until):
+            for bucketName, count in self._open(shard["seq"]).iterErrorRate(bucket, since, until):
+                counts[bucketName] = counts.get(bucketName, 0) + count
+        for bucketName in sorted(counts):
+            yield (bucketName, counts[bucketName])
+
+    def iterNewTraces(self, since, until):
+        traces = self._mergedTraces(NEW_TRACES_QUERY, since, until)
+        # a trace is only new if no older shard has seen it
+        for shard in self._shards():
+            if shard["first"] >= since or not traces:
+                continue
+            db = self._open(shard["seq"])
+            for fingerprint in list(traces):
+                if db._query("select 1 from traces where fingerprint = ? and first_seen < ?", fingerprint, since):
+                    del traces[fingerprint]
+        for traceId, count, shortError, firstSeen, lastSeen in sorted(traces.values(), key=lambda trace: (trace[3], trace[0])):
+            yield (traceId, firstSeen, lastSeen, count, shortError)
+
+    def _mergedTraces(self, query, since, until):
+        traces = {}
+        for shard in self._shardsBetween(since, until):
+            for fingerprint, traceId, count, shortError, firstSeen, lastSeen in self._open(shard["seq"])._iterQuery(query, since, until):
+                self._mergeTrace(traces, shard["seq"], fingerprint, traceId, count, shortError, firstSeen, lastSeen)
+        return traces
+
+    def _mergeTrace(self, traces, seq, fingerprint, traceId, count, shortError, firstSeen, lastSeen):
+        """ Fold a shard's row for a trace into traces, fingerprint -> [global id, count, short error, first seen, last seen]. """
+        trace = traces.get(fingerprint)
+        if trace is None:
+            traces[fingerprint] = [globalId(seq, traceId), count, shortError, firstSeen, lastSeen]
+            return
+        trace[1] += count
+        if firstSeen < trace[3]:
+            trace[0], trace[2], trace[3] = globalId(seq, traceId), shortError, firstSeen
+        trace[4] = max(trace[4], lastSeen)
+
+
+    def trainDictionary(self, sampleSize=2000):
+        """ Train a dictionary for the newest shard, the one new traces go in. """
+        shards = self._shards()
+        return self._open(shards[-1]["seq"]).trainDictionary(sampleSize) if shards else 0
+
+    def recompressTraces(self, batchSize=500):
+        return sum(self._open(shard["seq"]).recompressTraces(batchSize) for shard in self._shards())
+
+    def enableIncrementalVacuum(self):
+        for shard in self._shards():
+            self._open(shard["seq"]).enableIncrementalVacuum()
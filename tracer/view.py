@@ -1,5 +1,8 @@
 import curses
 import re
+import threading
+from collections import OrderedDict
+from tracer.common import needsSearchIndex
 from tracer.config import config
 
 try:
@@ -53,7 +56,12 @@ class MainWin(object):
         self.window = stdscr
         self.db = db
         self.isDetailPaneOpen = False
+        self.isFollowing = False
+        self.searchText = ""
+        self.followInterval = config.getint("tracer", "followInterval")
         self.detailPane = DetailPane(stdscr)
+        self.detailCache = DetailCache(db)
+        self.prefetchNeighbors = config.getint("tracer", "prefetchNeighbors")
         # colors
         foregroundColor = getCursesColor(config["tracer"]["foregroundColor"])
         backgroundColor = getCursesColor(config["tracer"]["backgroundColor"])
@@ -69,23 +77,32 @@ class MainWin(object):
         curses.curs_set(0) # Hide cursor
         self._setupDataList(stdscr)
         self._redraw()
-        self._listenForKeys()
+        curses.doupdate()
+        try:
+            self._listenForKeys()
+        finally:
+            self.detailCache.close()
 
     def _setupDataList(self, stdscr):
-        self.dataList = DataList(stdscr)
-        for error in self.db.fetchErrors():
-            self.dataList.addItem(error.getListText(), error.id)
+        self.dataList = DataList(stdscr, ErrorSource(self.db, self.searchText or None))
         self.dataList.scrollBottom()
 
     def refresh(self):
-        self.window.refresh()
+        self.window.noutrefresh()
         self.dataList.redraw()
 
     def _redraw(self):
+        """ Draw the title, borders and footer around the list and the detail pane. """
         screenLines, screenCols = self.window.getmaxyx()
         borderHorizontal = "─" * screenCols
-        self.window.clear()
-        self.window.addstr(0, 0, "Tracer".center(screenCols), curses.color_pair(INVERTED_COLORS));
+        # every row outside the list and the pane is written in full, so there's no need to
+        # clear the screen first and make curses send all of it to the terminal again
+        title = "Tracer"
+        if self.searchText:
+            title += " - /" + self.searchText
+        if self.isFollowing:
+            title += " (following)"
+        self.window.addstr(0, 0, title.center(screenCols), curses.color_pair(INVERTED_COLORS));
         if self.isDetailPaneOpen:
             self.window.addstr(5, 0, borderHorizontal, curses.color_pair(REGULAR_COLORS))
         self.window.addstr(1, 0, borderHorizontal, curses.color_pair(REGULAR_COLORS))
@@ -94,7 +111,7 @@ class MainWin(object):
             copyStr = "c - copy, " if PYPERCLIP_AVAILABLE else ""
             footerText = "n - next error, p - previous error, enter - close error, up/down/left/right - scroll error, " + copyStr + "q - quit"
         else:
-            footerText = "j/n/down arrow - next error, k/p/up arrow - previous error, enter - open error, r - reload, q - quit"
+            footerText = "j/n/down arrow - next error, k/p/up arrow - previous error, enter - open error, / - search (or class:, root:, at:), f - follow, r - reload, q - quit"
         try:
             self.window.addstr(screenLines - 1, 0, (" " + footerText).ljust(screenCols), curses.color_pair(INVERTED_COLORS))
         except: pass
@@ -105,7 +122,13 @@ class MainWin(object):
     def _listenForKeys(self):
         key = ""
         while (key != ord("q")):
+            # the windows only mark what changed, the terminal is updated once per key
+            curses.doupdate()
             key = self.window.getch()
+            # no key pressed before the follow interval ran out
+            if key == -1:
+                if self.isFollowing:
+                    self.checkForNewErrors()
             # k or up arrow
             if key == ord("k") or key == curses.KEY_UP:
                 if not self.isDetailPaneOpen:
@@ -164,21 +187,34 @@ class MainWin(object):
                     self.openDetailPane()
                 else:
                     self.closeDetailPane()
+            # /
+            elif key == ord("/"):
+                if not self.isDetailPaneOpen:
+                    self.promptSearch()
+            # f
+            elif key == ord("f"):
+                self.toggleFollow()
             # r
             elif key == ord("r"):
                 if not self.isDetailPaneOpen:
-                    self.__init__(self.window, self.db)
-                    return
+                    self._setupDataList(self.window)
+                    self._redraw()
             # c
             elif key == ord("c"):
                 if self.isDetailPaneOpen:
                     self.detailPane.copyToClipboard()
+            # terminal resized
+            elif key == curses.KEY_RESIZE:
+                self.resize()
 
     def openDetailPane(self):
+        if not self.dataList.numItems:
+            return
         self.isDetailPaneOpen = True
         errorId = self.dataList.getSelection()[1]
-        details = self.db.fetchErrorDetail(errorId)
-        self.detailPane.setData(details)
+        self.detailPane.setDetail(self.detailCache.get(errorId))
+        # n and p are the likely next keys, have the errors around this one ready for them
+        self.detailCache.prefetch(self.dataList.getNeighborData(self.prefetchNeighbors))
         self.dataList.shrink()
         self._redraw()
 
@@ -187,47 +223,194 @@ class MainWin(object):
         self.dataList.grow()
         self._redraw()
 
+    def resize(self):
+        """ Fit the windows to a resized terminal, keeping the loaded errors and the selection. """
+        curses.update_lines_cols()
+        self.window.erase()
+        try:
+            self.dataList.resizeScreen()
+            self.detailPane.resizeScreen(self.window)
+            self._redraw()
+        except curses.error: pass # too small to draw anything, wait for it to grow again
+
+    def promptSearch(self):
+        """ Read a search from the footer, narrowing the list to the matches as it is typed. """
+        screenLines, screenCols = self.window.getmaxyx()
+        previousText = self.searchText
+        text = self.searchText
+        curses.curs_set(1)
+        curses.set_escdelay(25)
+        self.window.timeout(-1)
+        canApply = True
+        while True:
+            self._showFooter("/" + text + ("" if canApply else "  (words need an sqlite built with fts5, use class:, root: or at:)"))
+            try:
+                self.window.move(screenLines - 1, min(len(text) + 2, screenCols - 1))
+            except: pass
+            key = self.window.get_wch()
+            if key == "\n":
+                break
+            elif key == "\x1b":
+                # escape puts back the search from before
+                text = previousText
+                self.setSearch(text)
+                break
+            elif key in (curses.KEY_BACKSPACE, "\x7f", "\b"):
+                text = text[:-1]
+            elif isinstance(key, str) and key.isprintable():
+                text += key
+            else:
+                continue
+            # without fts5 only the class:, root: and at: filters can be searched for
+            canApply = self.db.canSearch or not needsSearchIndex(text)
+            if canApply:
+                self.setSearch(text)
+        curses.curs_set(0)
+        if self.isFollowing:
+            self.window.timeout(self.followInterval)
+        self._redraw()
+
+    def setSearch(self, text):
+        self.searchText = text.strip()
+        self._setupDataList(self.window)
+
+    def _showFooter(self, text):
+        screenLines, screenCols = self.window.getmaxyx()
+        try:
+            self.window.addstr(screenLines - 1, 0, (" " + text).ljust(screenCols), curses.color_pair(INVERTED_COLORS))
+        except: pass
+        self.window.refresh()
+
+    def toggleFollow(self):
+        self.isFollowing = not self.isFollowing
+        if self.isFollowing:
+            self.dataVersion = self.db.fetchDataVersion()
+            self.window.timeout(self.followInterval)
+            self.dataList.loadNewItems()
+        else:
+            self.window.timeout(-1)
+        self._redraw()
+
+    def checkForNewErrors(self):
+        # data_version only changes when another connection commits, so most polls stop here
+        dataVersion = self.db.fetchDataVersion()
+        if dataVersion == self.dataVersion:
+            return
+        self.dataVersion = dataVersion
+        if self.dataList.loadNewItems():
+            self.dataList.redraw()
+            if self.isDetailPaneOpen:
+                self.detailPane.refresh()
+
+
+##########################################
+## SUPPLIES PAGES OF ERRORS TO THE LIST ##
+##########################################
+
+class ErrorSource(object):
+
+    def __init__(self, db, search=None):
+        self.db = db
+        self.search = search
+
+    def fetchBefore(self, errorId, limit):
+        return [(error.getListText(), error.id) for error in self.db.fetchErrorsBefore(errorId, limit, self.search)]
+
+    def fetchAfter(self, errorId, limit):
+        return [(error.getListText(), error.id) for error in self.db.fetchErrorsAfter(errorId, limit, self.search)]
+
 
 ###############################
 ## OBJECT FOR A LIST OF DATA ##
 ###############################
 
+# stands in for whatever a row showed before the list drew it, it never equals a row
+UNKNOWN_ROW = object()
+
 class DataList(object):
+    """
+    A scrolling list of items.
 
-    def __init__(self, parentWin):
+    When given a source, the list only holds a window of items around the selection and pages
+    more in from the source as it scrolls. The source fetches items before or after the data
+    of a given item, so it can page with keyset queries instead of loading everything up front.
+    """
+
+    def __init__(self, parentWin, source=None):
         screensize       = parentWin.getmaxyx()
         self.screenLines = screensize[0] - 4
         self.MAX_LINES   = self.screenLines
         self.screenCols  = screensize[1]
+        self.parentWin   = parentWin
         self.window      = parentWin.subwin(self.screenLines, self.screenCols, 2, 0)
+        self.isShrunk    = False
         self.index       = 0
         self.screenPos   = 0
         self.items       = []
         self.itemData    = []
         self.numItems    = 0
+        # paging, without a source all the items are always loaded
+        self.source      = source
+        self.atStart     = source is None
+        self.atEnd       = source is None
+        self.PAGE_SIZE   = max(self.MAX_LINES * 2, 1)
+        self.MAX_ITEMS   = self.PAGE_SIZE * 3
+        # (itemData, itemText, isSelected) of each row on screen, None for a blank row and
+        # UNKNOWN_ROW for a row that has to be drawn whatever it shows now
+        self.drawnRows   = [UNKNOWN_ROW] * self.screenLines
 
         self.window.keypad(1)
-    
+        self.window.idlok(True)
+
     def redraw(self):
-        self.window.clear()
+        """ Repaint the rows that changed since the last redraw, scrolling the window if the list moved. """
+        self._fill(self.screenPos, self.screenLines - self.screenPos)
         startIndex = self.index - self.screenPos
         if startIndex < 0: startIndex = 0
         endIndex = self.index + (self.screenLines - self.screenPos)
         if endIndex > self.numItems: endIndex = self.numItems
-        lineCount = 0
+        rows = [(self.itemData[i], self.items[i], i == self.index) for i in range(startIndex, endIndex)]
+        rows += [None] * (self.screenLines - len(rows))
+        self._scrollTo(rows)
         width = self.screenCols - 1
-        for i in range(startIndex, endIndex):
-            if i == self.index:
-                colors = curses.color_pair(INVERTED_COLORS)
-            else:
-                colors = curses.color_pair(REGULAR_COLORS)
+        for lineCount, row in enumerate(rows):
+            if row == self.drawnRows[lineCount]:
+                continue
             try:
-                lineStr = self.items[i]
-                lineStr = " " + lineStr[:width].ljust(width, " ")
-                self.window.addstr(lineCount, 0, lineStr, colors)
+                if row is None:
+                    self.window.move(lineCount, 0)
+                    self.window.clrtoeol()
+                else:
+                    itemData, lineStr, isSelected = row
+                    colors = curses.color_pair(INVERTED_COLORS if isSelected else REGULAR_COLORS)
+                    lineStr = " " + lineStr[:width].ljust(width, " ")
+                    self.window.addstr(lineCount, 0, lineStr, colors)
             except: pass
-            lineCount += 1
-        self.window.refresh()
+        self.drawnRows = rows
+        self.window.noutrefresh()
+
+    def _scrollTo(self, rows):
+        """ If rows are the drawn rows shifted up or down, scroll the window so they only need touching up. """
+        drawnData = [row[0] if isinstance(row, tuple) else None for row in self.drawnRows]
+        newData = [row[0] if isinstance(row, tuple) else None for row in rows]
+        shift = 0
+        if newData[0] is not None and newData[0] in drawnData:
+            shift = drawnData.index(newData[0])
+        elif drawnData[0] is not None and drawnData[0] in newData:
+            shift = -newData.index(drawnData[0])
+        if shift == 0:
+            return
+        self.window.scrollok(True)
+        self.window.scroll(shift)
+        self.window.scrollok(False)
+        if shift > 0:
+            self.drawnRows = self.drawnRows[shift:] + [None] * shift
+        else:
+            self.drawnRows = [None] * -shift + self.drawnRows[:shift]
+
+    def invalidate(self):
+        """ Make the next redraw paint every row, for when something else drew over the list. """
+        self.drawnRows = [UNKNOWN_ROW] * self.screenLines
 
     def addItem(self, itemText, itemData):
         self.items.append(itemText)
@@ -237,13 +420,89 @@ class DataList(object):
     def getSelection(self):
         return (self.items[self.index], self.itemData[self.index])
 
+    def getNeighborData(self, count):
+        """ The data of up to count loaded items either side of the selection, nearest first. """
+        neighbors = []
+        for distance in range(1, count + 1):
+            for i in (self.index + distance, self.index - distance):
+                if 0 <= i < self.numItems:
+                    neighbors.append(self.itemData[i])
+        return neighbors
+
+    def loadNewItems(self):
+        """ Append items added to the source since it was last read, keeping the selection where it is. """
+        if self.source is None or not self.atEnd:
+            # the end of the list isn't loaded, new items will be paged in when scrolled to
+            return 0
+        lastData = self.itemData[-1] if self.numItems else None
+        page = self.source.fetchAfter(lastData, self.PAGE_SIZE)
+        if len(page) == self.PAGE_SIZE: self.atEnd = False
+        for itemText, itemData in page:
+            self.addItem(itemText, itemData)
+        if self.numItems == len(page):
+            # the list was empty, nothing was selected yet
+            self.index = 0
+            self.screenPos = 0
+        # a list left following a busy source would otherwise grow forever
+        self._trimAbove()
+        self._trimBelow()
+        return len(page)
+
+    def _setItems(self, page):
+        self.items = [item[0] for item in page]
+        self.itemData = [item[1] for item in page]
+        self.numItems = len(page)
+
+    def _fill(self, before, after):
+        """ Make sure there are at least before items above and after items below the selection if the source has them. """
+        if not self.atStart and self.index - before < 0:
+            limit = max(self.PAGE_SIZE, before - self.index)
+            firstData = self.itemData[0] if self.numItems else None
+            page = self.source.fetchBefore(firstData, limit)
+            if len(page) < limit: self.atStart = True
+            self.items[0:0] = [item[0] for item in page]
+            self.itemData[0:0] = [item[1] for item in page]
+            self.numItems += len(page)
+            self.index += len(page)
+            self._trimBelow()
+        if not self.atEnd and self.index + after >= self.numItems:
+            limit = max(self.PAGE_SIZE, self.index + after - self.numItems + 1)
+            lastData = self.itemData[-1] if self.numItems else None
+            page = self.source.fetchAfter(lastData, limit)
+            if len(page) < limit: self.atEnd = True
+            self.items.extend(item[0] for item in page)
+            self.itemData.extend(item[1] for item in page)
+            self.numItems += len(page)
+            self._trimAbove()
+
+    def _trimAbove(self):
+        """ Drop items far above the selection once there are more than MAX_ITEMS. """
+        extra = min(self.numItems - self.MAX_ITEMS, self.index - self.PAGE_SIZE)
+        if extra > 0:
+            del self.items[:extra]
+            del self.itemData[:extra]
+            self.numItems -= extra
+            self.index -= extra
+            self.atStart = False
+
+    def _trimBelow(self):
+        """ Drop items far below the selection once there are more than MAX_ITEMS. """
+        extra = min(self.numItems - self.MAX_ITEMS, self.numItems - self.index - self.PAGE_SIZE)
+        if extra > 0:
+            del self.items[-extra:]
+            del self.itemData[-extra:]
+            self.numItems -= extra
+            self.atEnd = False
+
     def _fixScroll(self):
         """ Change the screenPos without changing index so there is no whitespace after the last line. """
+        self._fill(0, self.screenLines)
         if self.index + (self.screenLines - self.screenPos) >= self.numItems:
             self.screenPos = self.screenLines - (self.numItems - self.index)
             self.redraw()
 
     def scrollUp(self):
+        self._fill(1, 0)
         self.index -= 1
         self.screenPos -= 1
         if self.index < 0: self.index = 0
@@ -251,6 +510,7 @@ class DataList(object):
         self.redraw()
     
     def scrollDown(self):
+        self._fill(0, 1)
         self.index += 1
         self.screenPos += 1
         if self.index >= self.numItems: self.index = self.numItems - 1
@@ -258,16 +518,25 @@ class DataList(object):
         self.redraw()
 
     def scrollTop(self):
+        if not self.atStart:
+            self._setItems(self.source.fetchAfter(None, self.PAGE_SIZE))
+            self.atStart = True
+            self.atEnd = self.numItems < self.PAGE_SIZE
         self.index = 0
         self.screenPos = 0
         self.redraw()
 
     def scrollBottom(self):
+        if not self.atEnd:
+            self._setItems(self.source.fetchBefore(None, self.PAGE_SIZE))
+            self.atEnd = True
+            self.atStart = self.numItems < self.PAGE_SIZE
         self.index = self.numItems - 1
         self.screenPos = self.screenLines - 1
         self.redraw()
 
     def scrollPageUp(self):
+        self._fill(self.screenLines * 2, 0)
         if self.index == 0: return
         self.index -= self.screenLines
         linesBeforeCurPos = self.screenPos - 1
@@ -279,6 +548,7 @@ class DataList(object):
         self.redraw()
 
     def scrollPageDown(self):
+        self._fill(0, self.screenLines * 2)
         if self.index == self.numItems - 1: return
         self.index += self.screenLines
         linesAfterCurPos = self.screenLines - self.screenPos - 1
@@ -291,28 +561,56 @@ class DataList(object):
 
     def _resize(self, lines):
         # blank out window
-        self.window.clear()
-        self.window.refresh()
+        self.window.erase()
         # resize to smaller space and redraw
         self.window.resize(lines, self.screenCols)
         self.screenLines = lines
+        self.invalidate()
         # if screen pos off screen, move back
         if self.screenPos >= lines: self.screenPos = lines - 1
         self.redraw()
 
     def shrink(self):
+        self.isShrunk = True
         self._resize(3)
 
     def grow(self):
+        self.isShrunk = False
         self._resize(self.MAX_LINES)
         self._fixScroll()
 
+    def resizeScreen(self):
+        """ Fit the list to its parent window after the terminal was resized. """
+        screensize = self.parentWin.getmaxyx()
+        self.MAX_LINES = max(screensize[0] - 4, 1)
+        self.screenCols = screensize[1]
+        self.PAGE_SIZE = max(self.MAX_LINES * 2, 1)
+        self.MAX_ITEMS = self.PAGE_SIZE * 3
+        self.screenLines = min(3, self.MAX_LINES) if self.isShrunk else self.MAX_LINES
+        # a subwindow can't always be resized in place when its parent shrank, so make a new one
+        self.window = self.parentWin.subwin(self.screenLines, self.screenCols, 2, 0)
+        self.window.keypad(1)
+        self.window.idlok(True)
+        self.invalidate()
+        if self.screenPos >= self.screenLines: self.screenPos = self.screenLines - 1
+        if not self.isShrunk:
+            self._fixScroll()
+        self.redraw()
+
 
 #####################################
 ## A DETAIL PANE FOR THE DATA LIST ##
 #####################################
 
 class DetailPane(object):
+    """
+    Shows the full text of an error.
+
+    Only the lines in view are ever drawn, and a line is only checked against the highlight
+    patterns the first time it comes into view, so even traces with tens of thousands of
+    lines open instantly. Horizontal scrolling draws a slice of each line instead of keeping
+    a pad as wide as the widest line.
+    """
 
     def __init__(self, stdscr):
         screenSize = stdscr.getmaxyx()
@@ -320,36 +618,34 @@ class DetailPane(object):
         self.screenCols = screenSize[1]
         self.linePos = 0
         self.colPos = 0
-        self.pad = curses.newpad(1, 1)
+        self.window = stdscr.subwin(self.screenLines, self.screenCols, 6, 0)
+        self.setData("")
+
+    def resizeScreen(self, stdscr):
+        """ Fit the pane to the terminal after it was resized, keeping the error and position. """
+        screenSize = stdscr.getmaxyx()
+        self.screenLines = max(screenSize[0] - 8, 1)
+        self.screenCols = screenSize[1]
+        self.window = stdscr.subwin(self.screenLines, self.screenCols, 6, 0)
+        self.linePos = max(0, min(self.linePos, self.numLines - self.screenLines))
+        self.colPos = 0
 
     def setData(self, data):
+        self.setDetail(ErrorDetail(data))
+
+    def setDetail(self, detail):
         # reset position
         self.linePos = 0
         self.colPos = 0
-        # load new data
-        self.text = data
-        data = data.split("\n")
-        if isinstance(data, str):
-            data = [data]
-        self.numLines = len(data)
-        self.numCols = 0
-        for line in data:
-            if len(line) > self.numCols:
-                self.numCols = len(line)
-        self.pad.clear()
-        self.pad.resize(self.numLines, self.numCols)
-        for i in range(self.numLines):
-            try:
-                s = data[i]
-                if isHighlightedErrorLine(s):
-                    colors = curses.color_pair(ERROR_HIGHLIGHT_COLORS)
-                else:
-                    colors = curses.color_pair(REGULAR_COLORS)
-                self.pad.addstr(i, 0, s, colors)
-            except: pass
+        self.detail = detail
+        self.numLines = len(detail.lines)
+
+    @property
+    def numCols(self):
+        return self.detail.numCols
 
     def scrollBottom(self):
-        self.linePos = self.numLines - self.screenLines
+        self.linePos = max(0, self.numLines - self.screenLines)
         self.refresh()
 
     def scrollTop(self):
@@ -359,7 +655,7 @@ class DetailPane(object):
     def scrollDown(self):
         self.linePos += 1
         if self.linePos + self.screenLines >= self.numLines:
-            self.linePos = self.numLines - self.screenLines
+            self.linePos = max(0, self.numLines - self.screenLines)
         self.refresh()
 
     def scrollUp(self):
@@ -371,7 +667,7 @@ class DetailPane(object):
     def scrollRight(self):
         self.colPos += 5
         if self.colPos + self.screenCols >= self.numCols:
-            self.colPos = self.numCols - self.screenCols
+            self.colPos = max(0, self.numCols - self.screenCols)
         self.refresh()
 
     def scrollLeft(self):
@@ -389,13 +685,139 @@ class DetailPane(object):
     def scrollPageDown(self):
         self.linePos += self.screenLines
         if self.linePos + self.screenLines >= self.numLines:
-            self.linePos = self.numLines - self.screenLines
+            self.linePos = max(0, self.numLines - self.screenLines)
         self.refresh()
 
     def copyToClipboard(self):
         if PYPERCLIP_AVAILABLE:
-            pyperclip.copy(self.text)
+            pyperclip.copy(self.detail.text)
 
     def refresh(self):
-        self.pad.refresh(self.linePos,self.colPos, 6,0, self.screenLines+5,self.screenCols-1)
+        self.window.erase()
+        for row in range(min(self.screenLines, self.numLines - self.linePos)):
+            line, colors = self.detail.renderLine(self.linePos + row)
+            try:
+                self.window.addstr(row, 0, line[self.colPos:self.colPos + self.screenCols], colors)
+            except: pass # writing the bottom right corner raises after drawing
+        self.window.noutrefresh()
+
+
+
+##################################
+## THE TEXT OF AN ERROR TO SHOW ##
+##################################
+
+class ErrorDetail(object):
+    """
+    The lines of an error's text, with the highlighting of each line worked out the first
+    time it is drawn and kept, so going back to an error doesn't redo any of it.
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.lines = text.split("\n")
+        # line index -> (text with tabs expanded, colors), filled in as lines come into view
+        self.renderedLines = {}
+        self._numCols = None
+
+    @property
+    def numCols(self):
+        """ Width of the widest line, only worked out once scrolling right needs it. """
+        if self._numCols is None:
+            self._numCols = max(len(line.expandtabs()) for line in self.lines)
+        return self._numCols
+
+    @property
+    def size(self):
+        """ Rough memory use in bytes, the text plus its split lines. """
+        return len(self.text) * 2
+
+    def renderLine(self, index):
+        if index not in self.renderedLines:
+            line = self.lines[index]
+            if isHighlightedErrorLine(line):
+                colors = curses.color_pair(ERROR_HIGHLIGHT_COLORS)
+            else:
+                colors = curses.color_pair(REGULAR_COLORS)
+            self.renderedLines[index] = (line.expandtabs(), colors)
+        return self.renderedLines[index]
+
+
+#########################################
+## CACHES AND PREFETCHES ERROR DETAILS ##
+#########################################
 
+class DetailCache(object):
+    """
+    A least recently used cache of ErrorDetails, bounded by count and by size.
+
+    Errors asked for with prefetch are fetched by a background thread on its own read-only
+    connection, so stepping through errors with n/p rarely waits for the database, and a slow
+    prefetch never holds up the connection the viewer uses.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.maxItems = config.getint("tracer", "detailCacheSize")
+        self.maxBytes = config.getint("tracer", "detailCacheMemory") * 1024 * 1024
+        self.details = OrderedDict()
+        self.size = 0
+        self.condition = threading.Condition()
+        self.wanted = []
+        self.closed = False
+        self.thread = None
+
+    def get(self, errorId):
+        with self.condition:
+            detail = self.details.get(errorId)
+            if detail is not None:
+                self.details.move_to_end(errorId)
+                return detail
+        detail = ErrorDetail(self.db.fetchErrorDetail(errorId))
+        self._add(errorId, detail)
+        return detail
+
+    def prefetch(self, errorIds):
+        """ Fetch the given errors in the background, replacing any not fetched yet. """
+        if not self.maxItems:
+            return
+        with self.condition:
+            self.wanted = [errorId for errorId in errorIds if errorId not in self.details]
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="tracer-prefetch", daemon=True)
+                self.thread.start()
+            self.condition.notify()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+
+    def _add(self, errorId, detail):
+        with self.condition:
+            if errorId in self.details:
+                return
+            self.details[errorId] = detail
+            self.size += detail.size
+            # always keep the newest detail, even if it is bigger than the whole cache
+            while len(self.details) > 1 and (len(self.details) > self.maxItems or self.size > self.maxBytes):
+                oldestId, oldest = self.details.popitem(last=False)
+                self.size -= oldest.size
+
+    def _run(self):
+        db = type(self.db)(self.db.file, readOnly=True)
+        try:
+            while True:
+                with self.condition:
+                    while not self.wanted and not self.closed:
+                        self.condition.wait()
+                    if self.closed:
+                        return
+                    errorId = self.wanted.pop(0)
+                    if errorId in self.details:
+                        continue
+                try:
+                    self._add(errorId, ErrorDetail(db.fetchErrorDetail(errorId)))
+                except Exception: pass # the error may have been pruned, it will be fetched again if opened
+        finally:
+            db.close()
@@ -0,0 +1,172 @@
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from collections import deque
+from tracer.common import currentTimestamp
+from tracer.config import config
+
+#####################################################
+## WRITES ERRORS TO THE DATABASE IN THE BACKGROUND ##
+#####################################################
+
+OVERFLOW_POLICIES = ("block", "dropoldest", "spill")
+
+class ErrorWriter(object):
+    """
+    Hands errors to a background thread that writes them to the database.
+
+    The parser only appends to a bounded queue, so a slow disk or a locked database never holds
+    up log passthrough. Once the queue is full the configured overflow policy decides whether
+    the parser waits, the oldest queued error is dropped, or the error is spilled to a file and
+    written once the queue has drained.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.queueSize = config.getint("writer", "queueSize")
+        self.overflow = config["writer"]["overflow"].strip().lower()
+        if self.overflow not in OVERFLOW_POLICIES:
+            raise Exception("Invalid value for overflow: " + config["writer"]["overflow"])
+        self.spillFile = config["writer"]["spillFile"].strip() or db.file + ".spill"
+        self.queue = deque()
+        self.condition = threading.Condition()
+        self.closed = False
+        self.flushRequested = False
+        self.hasSpilled = os.path.isfile(self.spillFile)
+        # after a failed write the spilled errors are tried again with a growing delay
+        self.retryDelay = 0
+        self.retryAt = 0
+        self.droppedErrors = 0
+        # old errors are pruned between writes, see DBManager.pruneStep
+        self.pruneInterval = config.getint("retention", "checkInterval")
+        self.nextPrune = time.monotonic()
+        self.thread = threading.Thread(target=self._run, name="tracer-writer", daemon=True)
+        self.thread.start()
+
+    def addError(self, shortError, fullError, fingerprint, source=None, occurrences=1):
+        error = (shortError, fullError, fingerprint, currentTimestamp(), source, occurrences)
+        with self.condition:
+            if len(self.queue) >= self.queueSize:
+                if self.overflow == "block":
+                    while len(self.queue) >= self.queueSize and self.thread.is_alive():
+                        self.condition.wait()
+                elif self.overflow == "dropoldest":
+                    self.queue.popleft()
+                    self.droppedErrors += 1
+                else:
+                    self._spill([error])
+                    self.hasSpilled = True
+                    return
+            self.queue.append(error)
+            self.condition.notify_all()
+
+    def flushIfDue(self):
+        # the writer thread keeps track of the batch interval itself
+        pass
+
+    def flush(self):
+        """ Wait until every queued error has been committed. """
+        with self.condition:
+            self.flushRequested = True
+            self.condition.notify_all()
+            while (self.queue or self.flushRequested) and self.thread.is_alive():
+                self.condition.wait()
+
+    def close(self):
+        """ Drain the queue into the database and stop the writer thread. """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join()
+        if self.droppedErrors:
+            print("tracer: dropped " + str(self.droppedErrors) + " errors while the database writer was behind", file=sys.stderr)
+
+    def _run(self):
+        while True:
+            with self.condition:
+                if not self.queue and not self.closed and not self.flushRequested:
+                    self.condition.wait(max(0, min(self.db.batchInterval, self._timeUntilPrune(), self._timeUntilRetry())))
+                errors = list(self.queue)
+                self.queue.clear()
+                closed = self.closed
+                flushRequested = self.flushRequested
+                # closing tries the spill once more straight away
+                reloadSpill = self.hasSpilled and not errors and (closed or self._timeUntilRetry() <= 0)
+                if reloadSpill:
+                    self.hasSpilled = False
+                # wake up a parser blocked on a full queue
+                self.condition.notify_all()
+            if reloadSpill:
+                errors = self._takeSpill()
+            self._write(errors, closed or flushRequested)
+            if not closed and self._timeUntilPrune() <= 0:
+                self._prune()
+            with self.condition:
+                if flushRequested and not self.queue:
+                    self.flushRequested = False
+                self.condition.notify_all()
+                if closed and not self.queue and (not self.hasSpilled or self.retryDelay):
+                    if self.hasSpilled:
+                        print("tracer: unwritten errors were left in " + self.spillFile + " for the next run", file=sys.stderr)
+                    return
+
+    def _write(self, errors, commit):
+        written = 0
+        try:
+            for error in errors:
+                written += 1
+                self.db.addError(*error)
+            if commit:
+                self.db.flush()
+            else:
+                self.db.flushIfDue()
+            self.retryDelay = 0
+        except sqlite3.Error as e:
+            # keep the errors in the spill file and try them again later rather than losing them
+            print("tracer: could not write errors to the database: " + str(e), file=sys.stderr)
+            unwritten = [(shortError, fullError, fingerprint, date, source, occurrences) for date, shortError, fullError, fingerprint, source, occurrences in self.db.pendingErrors]
+            self.db.pendingErrors[:] = []
+            with self.condition:
+                self._spill(unwritten + errors[written:])
+                self.hasSpilled = True
+            self.retryDelay = min(max(self.retryDelay * 2, 1), 60)
+            self.retryAt = time.monotonic() + self.retryDelay
+
+    def _timeUntilPrune(self):
+        if not self.db.hasRetention:
+            return float("inf")
+        return self.nextPrune - time.monotonic()
+
+    def _timeUntilRetry(self):
+        if not self.hasSpilled:
+            return float("inf")
+        return self.retryAt - time.monotonic()
+
+    def _prune(self):
+        try:
+            hasMore = self.db.pruneStep()
+        except sqlite3.Error as e:
+            print("tracer: could not prune old errors: " + str(e), file=sys.stderr)
+            hasMore = False
+        # keep going between writes until everything past the limits is gone
+        self.nextPrune = time.monotonic() + (0 if hasMore else self.pruneInterval)
+
+    def _spill(self, errors):
+        """ Append errors to the spill file, the condition must be held. """
+        with open(self.spillFile, "a", encoding="utf-8") as spillFile:
+            for error in errors:
+                spillFile.write(json.dumps(error) + "\n")
+
+    def _takeSpill(self):
+        """ Read back and remove the spill file. """
+        with self.condition:
+            try:
+                with open(self.spillFile, encoding="utf-8") as spillFile:
+                    errors = [tuple(json.loads(line)) for line in spillFile if line.strip()]
+                os.remove(self.spillFile)
+            except FileNotFoundError:
+                errors = []
+        return errors